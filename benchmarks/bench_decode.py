@@ -0,0 +1,72 @@
+"""Compare decoding fetch_multi results the old way, through ResultSet.get_points,
+against _read_buckets.
+
+usage: python benchmarks/bench_decode.py [num_series] [num_points] [null_ratio]"""
+import os
+import sys
+import time
+import random
+import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from influxdb.resultset import ResultSet
+import graphite_influxdb
+
+
+def make_response(num_series, num_points, null_ratio, first_bucket=1400000000, step=10):
+    rand = random.Random(42)
+    return {'series': [{'name': 'some.metric.%d' % i,
+                        'columns': ['time', 'value'],
+                        'values': [[first_bucket + j * step,
+                                    None if rand.random() < null_ratio else rand.random()]
+                                   for j in range(num_points)]}
+                       for i in range(num_series)]}
+
+
+def make_graphite_api_points_list(influxdb_data):
+    """Make graphite-api data points dictionary from Influxdb ResultSet data,
+    as fetch_multi used to"""
+    _data = {}
+    for key in influxdb_data.keys():
+        _data[key[0]] = [(datetime.datetime.fromtimestamp(float(d['time'])),
+                          d['value']) for d in influxdb_data.get_points(key[0])]
+    return _data
+
+
+def old_decode(raw):
+    data = make_graphite_api_points_list(ResultSet(raw))
+    return dict((key, [v[1] for v in values]) for (key, values) in data.items())
+
+
+def new_decode(raw, num_points, first_bucket=1400000000, step=10):
+    return graphite_influxdb._read_buckets(raw, first_bucket, num_points, step)
+
+
+def bench(name, func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        took = time.time() - start
+        best = took if best is None else min(best, took)
+    print("%-40s %8.3fs" % (name, best))
+    return best, result
+
+
+def main():
+    num_series = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_points = int(sys.argv[2]) if len(sys.argv) > 2 else 8640
+    null_ratio = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+    print("decoding %d series x %d points, %d%% nulls" % (num_series, num_points, null_ratio * 100))
+    raw = make_response(num_series, num_points, null_ratio)
+    old, expected = bench("make_graphite_api_points_list", lambda: old_decode(raw))
+    new, got = bench("_read_buckets", lambda: new_decode(raw, num_points))
+    assert got == expected
+    # drop every other row, as influxdb does with fill(none), to measure the slow path
+    for series in raw['series']:
+        series['values'] = series['values'][::2]
+    gaps, _ = bench("_read_buckets (with gaps)", lambda: new_decode(raw, num_points))
+    print("speedup: %.1fx (%.1fx with gaps)" % (old / new, old / gaps))
+
+
+if __name__ == '__main__':
+    main()
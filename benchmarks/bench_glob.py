@@ -0,0 +1,116 @@
+"""Compare matching series names against graphite globs the old way (compile_regex
+rebuilding the regex with str.replace on every call, and matching every name with it)
+against the memoized Globs of compile_glob.
+
+usage: python benchmarks/bench_glob.py [num_series] [rounds]"""
+import os
+import re
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import graphite_influxdb
+
+# what a typical dashboard asks for: exact targets, trailing wildcards, wildcards
+# in the middle and alternatives
+QUERIES = [
+    'servers.web01.cpu.user',
+    'servers.web01.cpu.*',
+    'servers.*',
+    'servers.web*',
+    'servers.*.cpu.user',
+    'servers.{web01,web02,db01}.memory.*',
+    'servers.web0[1-5].load.*',
+    'apps.checkout.requests.*',
+    'apps.*.errors.count',
+    'apps.checkout.latency.p9?',
+]
+
+
+def make_series(num_series):
+    series = []
+    hosts = max(1, num_series // 40)
+    for i in range(hosts):
+        host = ('web%02d' if i % 3 else 'db%02d') % i
+        for group, metrics in (('cpu', ('user', 'system', 'idle', 'iowait')),
+                               ('memory', ('used', 'free', 'cached', 'buffers')),
+                               ('load', ('shortterm', 'midterm', 'longterm'))):
+            series.extend('servers.%s.%s.%s' % (host, group, m) for m in metrics)
+    apps = max(1, num_series // 200)
+    for i in range(apps):
+        app = 'checkout' if i == 0 else 'app%d' % i
+        series.extend('apps.%s.requests.%s' % (app, code) for code in ('2xx', '3xx', '4xx', '5xx'))
+        series.extend('apps.%s.latency.p%d' % (app, p) for p in (50, 75, 90, 95, 99))
+        series.append('apps.%s.errors.count' % app)
+    return series
+
+
+def old_compile_regex(fmt, pattern):
+    return re.compile(fmt.format(
+        pattern.replace('.', '\\.').replace('*', '[^\\.]*').replace(
+            '{', '(').replace(',', '|').replace('}', ')')))
+
+
+def old_find(series, pattern):
+    # one compile for assure_series, then one each for get_leaves and get_branches
+    old_compile_regex('^{0}', pattern)
+    regex = old_compile_regex('^{0}$', pattern)
+    leaves = [name for name in series if regex.match(name)]
+    regex = old_compile_regex('^{0}$', pattern)
+    return leaves, regex
+
+
+def new_find(series, pattern):
+    graphite_influxdb.compile_glob_regex('^{0}', pattern)
+    glob = graphite_influxdb.compile_glob(pattern)
+    return glob.filter(series), glob
+
+
+def bench(name, func, series, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        for pattern in QUERIES:
+            func(series, pattern)
+    took = time.time() - start
+    print("%-28s %8.3fs  %8.1f finds/s" % (name, took, rounds * len(QUERIES) / took))
+    return took
+
+
+def main():
+    num_series = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    series = make_series(num_series)
+    print("matching %d queries against %d series, %d rounds" % (len(QUERIES), len(series), rounds))
+    for pattern in QUERIES:
+        # the old translation turned ? into a regex quantifier
+        if '?' not in pattern:
+            assert old_find(series, pattern)[0] == new_find(series, pattern)[0], pattern
+    old = bench("compile_regex (old)", old_find, series, rounds)
+    new = bench("compile_glob", new_find, series, rounds)
+    print("speedup: %.1fx" % (old / new))
+    for pattern in QUERIES:
+        glob = graphite_influxdb.compile_glob(pattern)
+        kind = 'literal' if glob.is_literal else 'prefix' if glob.is_prefix else 'regex'
+        timings = []
+        for func in (old_find, new_find):
+            start = time.time()
+            for _ in range(rounds):
+                func(series, pattern)
+            timings.append(time.time() - start)
+        print("  %-38s %-8s %5.1fx" % (pattern, kind, timings[0] / timings[1]))
+    compile_rounds = rounds * 1000
+    start = time.time()
+    for _ in range(compile_rounds):
+        for pattern in QUERIES:
+            old_compile_regex('^{0}$', pattern)
+    old = time.time() - start
+    start = time.time()
+    for _ in range(compile_rounds):
+        for pattern in QUERIES:
+            graphite_influxdb.compile_glob(pattern)
+    new = time.time() - start
+    print("compiling only: %.1fx faster (%.2fus vs %.2fus per pattern)" % (
+        old / new, old * 1e6 / compile_rounds / len(QUERIES), new * 1e6 / compile_rounds / len(QUERIES)))
+
+
+if __name__ == '__main__':
+    main()
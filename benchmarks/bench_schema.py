@@ -0,0 +1,57 @@
+"""Compare resolving the step of series by trying every schema pattern in turn (the old way)
+against StepResolver's combined regex, with and without its per-name cache warmed up.
+
+usage: python benchmarks/bench_schema.py [num_series]"""
+import os
+import re
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import graphite_influxdb
+
+
+def make_schema(size):
+    # mostly rules that don't match, like in a long storage-schemas.conf,
+    # followed by the ones that do
+    schema = [('^team%d\\.service[0-9]+\\.' % i, 10 * (i % 6 + 1)) for i in range(size - 2)]
+    return schema + [('^servers\\..*\\.cpu', 10), ('', 60)][-size:]
+
+
+def make_series(num_series):
+    return ['servers.host%d.%s.value%d' % (i // 20, ('cpu', 'memory')[i % 2], i % 10)
+            for i in range(num_series)]
+
+
+def linear(schemas, series):
+    return [next((res for (patt, res) in schemas if patt.match(name)), 60) for name in series]
+
+
+def resolved(resolver, series):
+    get_step = resolver.get_step
+    return [get_step(name) for name in series]
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    num_series = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    series = make_series(num_series)
+    print("resolving the step of %d series" % num_series)
+    print("%12s %12s %12s %12s %10s" % ('schema size', 'linear', 'combined', 'cached', 'speedup'))
+    for size in (1, 5, 20, 50, 200):
+        schema = make_schema(size)
+        schemas = [(re.compile(patt), step) for (patt, step) in schema]
+        old, expected = timed(linear, schemas, series)
+        resolver = graphite_influxdb.StepResolver(schema, cache_size=num_series)
+        new, got = timed(resolved, resolver, series)
+        cached, got_cached = timed(resolved, resolver, series)
+        assert got == expected == got_cached
+        print("%12d %11.3fs %11.3fs %11.3fs %9.1fx" % (size, old, new, cached, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""Benchmark finds and fetches end to end, fully offline.
+
+Starts a local HTTP server that speaks enough of the InfluxDB /query protocol (and of the
+ES search/scroll api, with --es) to serve a synthetic keyspace, and times find_nodes,
+get_leaves, get_branches and fetch_multi of a real InfluxdbFinder against it, as well as
+decoding query results.  Reports throughput, latency percentiles and peak memory.
+
+With --save-baseline the results are written to a json file; with --baseline they're
+compared against such a file, and the run fails when an operation got slower than
+the baseline by more than --tolerance.
+
+usage: python benchmarks/bench_suite.py [--series N] [--repeat N] [--index] [--es]
+                                        [--baseline FILE] [--save-baseline FILE]"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+try:
+    from urllib.parse import urlparse, parse_qs
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from urlparse import urlparse, parse_qs
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from graphite_api.storage import FindQuery
+import graphite_influxdb
+from bench_glob import QUERIES, make_series
+from bench_decode import make_response
+
+SELECT = re.compile(r'select mean\(value\) as value from (?P<series>.*) '
+                    r'where \((?P<where>.*)\) GROUP BY time\((?P<step>\d+)s\)$')
+CONDITION = re.compile(r'time ([<>]=?) (\d+)s$')
+
+
+class FakeBackend(object):
+    """Answers the queries of the finder from a list of series names.
+    Every series has a point in every bucket but one in ten, derived from its name and the time."""
+
+    def __init__(self, series):
+        self.series = series
+        self.scrolls = {}
+        self.lock = threading.Lock()
+
+    def influxdb(self, query):
+        if query.startswith('show series'):
+            match = re.match('show series from /(.*)/$', query)
+            regex = re.compile(match.group(1)) if match else None
+            names = [name for name in self.series if regex is None or regex.search(name)]
+            return [{'columns': ['key'], 'values': [[name] for name in names]}] if names else []
+        match = SELECT.match(query)
+        if match is None:
+            raise ValueError("unsupported query: %s" % query)
+        step = int(match.group('step'))
+        times = [int(ts) for (_, ts) in (CONDITION.match(c).groups() for c in match.group('where').split(' and '))]
+        first, last = min(times), max(times)
+        buckets = range(first - first % step, last - last % step + 1, step)
+        series = []
+        for name in re.findall(r'"([^"]+)"(?=,|$)', match.group('series')):
+            seed = len(name) * 31 + ord(name[-1])
+            series.append({'name': name, 'columns': ['time', 'value'],
+                           'values': [[ts, None if (ts // step + seed) % 10 == 0 else float((ts // step + seed) % 100)]
+                                      for ts in buckets]})
+        return series
+
+    def es_search(self, body, size):
+        query = body['query']
+        if 'prefix' in query:
+            ((field, prefix),) = query['prefix'].items()
+            names = [name for name in self.series if name.startswith(prefix)]
+        elif 'regexp' in query:
+            ((field, pattern),) = query['regexp'].items()
+            regex = re.compile(pattern + '$')
+            names = [name for name in self.series if regex.match(name)]
+        else:
+            raise ValueError("unsupported query: %s" % query)
+        with self.lock:
+            scroll_id = str(len(self.scrolls) + 1)
+            self.scrolls[scroll_id] = (field, names, size)
+        return self.es_page(scroll_id)
+
+    def es_page(self, scroll_id):
+        with self.lock:
+            field, names, size = self.scrolls[scroll_id]
+            self.scrolls[scroll_id] = (field, names[size:], size)
+        return {'_shards': {'successful': 1}, '_scroll_id': scroll_id,
+                'hits': {'hits': [{'fields': {field: [name]}} for name in names[:size]]}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, lines):
+        payload = ''.join(json.dumps(line) + '\n' for line in lines).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        params = dict((key, values[0]) for (key, values) in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        backend = self.server.backend
+        if url.path == '/query':
+            params.update((key, values[0]) for (key, values) in parse_qs(body.decode('utf-8')).items())
+            series = backend.influxdb(params['q'])
+            if params.get('chunked') == 'true':
+                # one result per line, at most chunk_size rows each, like influxdb does
+                chunk_size = int(params.get('chunk_size') or 10000)
+                lines = []
+                for serie in series:
+                    rows = serie['values']
+                    for i in range(0, max(len(rows), 1), chunk_size):
+                        piece = dict(serie, values=rows[i:i + chunk_size])
+                        if i + chunk_size < len(rows):
+                            piece['partial'] = True
+                        lines.append({'results': [{'statement_id': 0, 'series': [piece]}]})
+                self.reply(lines or [{'results': [{'statement_id': 0}]}])
+            else:
+                self.reply([{'results': [{'statement_id': 0, 'series': series}]}])
+        elif url.path.endswith('/_search/scroll'):
+            body = json.loads(body.decode('utf-8')) if body else {}
+            if method == 'DELETE':
+                self.reply([{'succeeded': True}])
+            else:
+                self.reply([backend.es_page(body.get('scroll_id') or params['scroll_id'])])
+        elif url.path.endswith('/_search'):
+            self.reply([backend.es_search(json.loads(body.decode('utf-8')), int(params.get('size', 10)))])
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(series):
+    server = Server(('127.0.0.1', 0), Handler)
+    server.backend = FakeBackend(series)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def measure(func, repeat):
+    """Time repeat calls of func (after one warm-up call), and the peak memory of one more"""
+    func()
+    latencies = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        latencies.append(time.time() - start)
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'ops_per_sec': repeat / sum(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p90_ms': percentile(latencies, 90) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'peak_kb': peak / 1024.0 if peak is not None else None}
+
+
+def run(args):
+    series = make_series(args.series)
+    # make_series only roughly has the requested number of series
+    series = make_series(args.series * args.series // len(series))
+    server = start_server(series)
+    config = {'influxdb': {'host': '127.0.0.1', 'port': server.server_address[1], 'db': 'bench',
+                           'schema': [['^servers', 10]], 'log_level': 'warning',
+                           'index_enabled': args.index,
+                           'fetch_streaming': args.streaming}}
+    if args.es:
+        config['es'] = {'enabled': True, 'hosts': ['127.0.0.1:%d' % server.server_address[1]],
+                        'index': 'graphite_metrics', 'field': '_id'}
+    finder = graphite_influxdb.InfluxdbFinder(config)
+    graphite_influxdb._series_indexes.clear()
+    now = int(time.time())
+    start_time = now - args.range
+
+    def query(pattern):
+        return FindQuery(pattern, start_time, now)
+
+    def find_all(method):
+        def run_queries():
+            for pattern in QUERIES:
+                for _ in method(query(pattern)):
+                    pass
+        return run_queries
+
+    nodes = [node for node in finder.find_nodes(query('servers.*.cpu.*')) if node.is_leaf][:args.fetch_series]
+    num_points = args.range // 10
+    raw = make_response(args.fetch_series, num_points, 0.1)
+    operations = [
+        ('find_nodes', find_all(finder.find_nodes)),
+        ('get_leaves', find_all(finder.get_leaves)),
+        ('get_branches', find_all(finder.get_branches)),
+        ('fetch_multi', lambda: finder.fetch_multi(nodes, start_time, now)),
+        ('decode', lambda: graphite_influxdb._read_buckets(raw, 1400000000, num_points, 10)),
+    ]
+    print("%d series, %d find queries per round, fetching %d series x %d points, %d rounds" % (
+        len(series), len(QUERIES), len(nodes), num_points, args.repeat))
+    results = {}
+    for (name, func) in operations:
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure(func, args.repeat)
+    server.shutdown()
+    return {'series': len(series), 'results': results}
+
+
+def report(run_results, baseline, tolerance):
+    """Print the results, next to the baseline if any.  Returns the names of the operations that regressed"""
+    regressions = []
+    print("%-14s %10s %10s %10s %10s %12s %10s" % ('operation', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'peak KiB', 'vs base'))
+    for (name, result) in sorted(run_results['results'].items()):
+        compared = ''
+        base = (baseline or {}).get('results', {}).get(name)
+        if base:
+            ratio = result['p50_ms'] / base['p50_ms']
+            compared = '%.2fx' % ratio
+            if ratio > 1 + tolerance:
+                compared += ' SLOWER'
+                regressions.append(name)
+        peak = '%12.1f' % result['peak_kb'] if result['peak_kb'] is not None else '%12s' % '-'
+        print("%-14s %10.1f %10.2f %10.2f %10.2f %s %10s" % (
+            name, result['ops_per_sec'], result['p50_ms'], result['p90_ms'], result['p99_ms'], peak, compared))
+    if baseline and baseline.get('series') != run_results['series']:
+        print("warning: the baseline was measured with %s series" % baseline.get('series'))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--series', type=int, default=10000, help='approximate size of the keyspace')
+    parser.add_argument('--repeat', type=int, default=20, help='timed rounds per operation')
+    parser.add_argument('--range', type=int, default=6 * 3600, help='seconds of data to fetch')
+    parser.add_argument('--fetch-series', type=int, default=100, help='series per fetch_multi')
+    parser.add_argument('--index', action='store_true', help='resolve finds with the in-memory index')
+    parser.add_argument('--es', action='store_true', help='list series through the ES stand-in')
+    parser.add_argument('--streaming', action='store_true', help='fetch with chunked responses')
+    parser.add_argument('--only', nargs='*', help='only run these operations')
+    parser.add_argument('--baseline', help='json file to compare against')
+    parser.add_argument('--save-baseline', help='json file to save the results to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='how much slower (p50) than the baseline an operation may be')
+    args = parser.parse_args()
+    results = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print("regressions: %s" % ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,18 @@
+import os
 import re
+import sys
+import mmap
 import time
+import struct
+import random
 import logging
+import threading
+from collections import OrderedDict, deque
+from functools import reduce
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
 from logging.handlers import TimedRotatingFileHandler
 import datetime
 from influxdb import InfluxDBClient
@@ -8,6 +20,14 @@ try:
     import statsd
 except ImportError:
     pass
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    pass
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger('graphite_influxdb')
 
@@ -25,6 +45,19 @@ except ImportError:
 # Tell influxdb to return time as seconds from epoch
 _INFLUXDB_CLIENT_PARAMS = {'epoch' : 's'}
 
+try:
+    _intern = sys.intern
+except AttributeError:
+    def _intern(name):
+        # python 2 only interns byte strings, and the influxdb client returns unicode names
+        return intern(name) if type(name) is str else name
+
+# characters that make a graphite path segment a glob rather than a literal
+_GLOB_CHARS = re.compile(r'[*?\[{]')
+# characters that need escaping in regexes, for python as well as influxdb (including the
+# '/' delimiters of its regexes) and elasticsearch
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()/')
+
 class NullStatsd():
     def __enter__(self):
         return self
@@ -38,6 +71,9 @@ class NullStatsd():
     def timing(self, key, val):
         pass
 
+    def incr(self, key, count=1):
+        pass
+
     def start(self):
         pass
 
@@ -45,6 +81,129 @@ class NullStatsd():
         pass
 
 
+class NullProfiler(object):
+    """Profiler that doesn't profile anything, so instrumented code costs next to nothing"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def begin(self, kind, target):
+        return None
+
+    def end(self, profile):
+        pass
+
+    def phase(self, name):
+        return self
+
+    def count(self, name, n=1):
+        pass
+
+    def wrap(self, func):
+        return func
+
+
+class RequestProfile(object):
+    """Breakdown of one find or fetch: seconds spent per phase (summed over all threads
+    working on it) and counts, like the number of series and points"""
+    __slots__ = ('kind', 'target', 'started', 'duration', 'phases', 'counts', 'lock')
+
+    def __init__(self, kind, target):
+        self.kind = kind
+        self.target = target
+        self.started = time.time()
+        self.duration = None
+        self.phases = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def count(self, name, n):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def as_dict(self):
+        return {'kind': self.kind, 'target': self.target, 'started': self.started,
+                'duration': self.duration, 'phases': dict(self.phases), 'counts': dict(self.counts)}
+
+
+class _Phase(object):
+    __slots__ = ('profile', 'name', 'started')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.profile.add(self.name, time.time() - self.started)
+
+
+class Profiler(NullProfiler):
+    """Sampling profiler: profiles a sample_rate fraction of the finds and fetches, and keeps
+    the RequestProfiles of the last size sampled ones in a ring buffer.
+    The profile of the request being handled is tracked per thread."""
+    __slots__ = ('sample_rate', 'samples', 'local')
+
+    def __init__(self, sample_rate, size=1000):
+        self.sample_rate = sample_rate
+        self.samples = deque(maxlen=size)
+        self.local = threading.local()
+
+    def begin(self, kind, target):
+        """Start profiling a request in this thread, if it's sampled.  Returns its profile, or None"""
+        profile = RequestProfile(kind, target) if random.random() < self.sample_rate else None
+        self.local.profile = profile
+        return profile
+
+    def end(self, profile):
+        self.local.profile = None
+        if profile is not None:
+            profile.duration = time.time() - profile.started
+            self.samples.append(profile)
+
+    def phase(self, name):
+        """Context manager timing a phase of the request being profiled in this thread"""
+        profile = getattr(self.local, 'profile', None)
+        return _Phase(profile, name) if profile is not None else self
+
+    def count(self, name, n=1):
+        profile = getattr(self.local, 'profile', None)
+        if profile is not None:
+            profile.count(name, n)
+
+    def wrap(self, func):
+        """Make func record into the profile of the current thread, when run in another thread"""
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            return func
+
+        def profiled(*args):
+            self.local.profile = profile
+            try:
+                return func(*args)
+            finally:
+                self.local.profile = None
+        return profiled
+
+
+def _parse_bool(value):
+    """Accept both real booleans (yaml) and 'true'/'false' strings (django settings)"""
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value)
+
+
 def normalize_config(config=None):
     ret = {}
     if config is not None:
@@ -59,11 +218,36 @@ def normalize_config(config=None):
         ret['schema'] = cfg.get('schema', [])
         ret['log_file'] = cfg.get('log_file', None)
         ret['log_level'] = cfg.get('log_level', 'info')
+        ret['index_enabled'] = _parse_bool(cfg.get('index_enabled', False))
+        ret['index_refresh_interval'] = int(cfg.get('index_refresh_interval', 600))
+        ret['index_snapshot_path'] = cfg.get('index_snapshot_path', None)
+        ret['fetch_cache_max_bytes'] = int(cfg.get('fetch_cache_max_bytes', 0))
+        ret['fetch_cache_ttl'] = int(cfg.get('fetch_cache_ttl', 10))
+        ret['fetch_cache_historical_ttl'] = int(cfg.get('fetch_cache_historical_ttl', 3600))
+        ret['incremental_fetch'] = _parse_bool(cfg.get('incremental_fetch', False))
+        ret['incremental_fetch_lag'] = int(cfg.get('incremental_fetch_lag', 60))
+        ret['incremental_fetch_max_bytes'] = int(cfg.get('incremental_fetch_max_bytes', 64 * 1024 * 1024))
+        ret['fetch_step_mode'] = cfg.get('fetch_step_mode', 'max')
+        ret['fetch_chunk_size'] = int(cfg.get('fetch_chunk_size', 1000))
+        ret['fetch_concurrency'] = int(cfg.get('fetch_concurrency', 1))
+        ret['query_timeout'] = cfg.get('query_timeout', None)
+        ret['fetch_streaming'] = _parse_bool(cfg.get('fetch_streaming', False))
+        ret['fetch_stream_chunk_size'] = int(cfg.get('fetch_stream_chunk_size', 10000))
+        ret['max_data_points'] = int(cfg.get('max_data_points', 0))
+        ret['rollups'] = cfg.get('rollups', [])
+        ret['coalesce_requests'] = _parse_bool(cfg.get('coalesce_requests', True))
+        ret['coalesce_timeout'] = float(cfg.get('coalesce_timeout', 30))
+        ret['profile_sample_rate'] = float(cfg.get('profile_sample_rate', 0))
+        ret['profile_buffer_size'] = int(cfg.get('profile_buffer_size', 1000))
         cfg = config.get('es', {})
         ret['es_enabled'] = cfg.get('enabled', False)
         ret['es_index'] = cfg.get('index', 'graphite_metrics2')
         ret['es_hosts'] = cfg.get('hosts', ['localhost:9200'])
         ret['es_field'] = cfg.get('field', '_id')
+        ret['es_depth_field'] = cfg.get('depth_field', None)
+        ret['es_page_size'] = int(cfg.get('page_size', 10000))
+        ret['es_max_hits'] = int(cfg.get('max_hits', 0))
+        ret['es_timeout'] = int(cfg.get('timeout', 10))
         if config.get('statsd', None):
             ret['statsd'] = config.get('statsd')
     else:
@@ -81,69 +265,976 @@ def normalize_config(config=None):
         # Default log level is 'info'
         ret['log_level'] = getattr(
             settings, 'INFLUXDB_LOG_LEVEL', 'info')
+        ret['index_enabled'] = _parse_bool(getattr(
+            settings, 'INFLUXDB_INDEX_ENABLED', False))
+        ret['index_refresh_interval'] = int(getattr(
+            settings, 'INFLUXDB_INDEX_REFRESH_INTERVAL', 600))
+        ret['index_snapshot_path'] = getattr(
+            settings, 'INFLUXDB_INDEX_SNAPSHOT_PATH', None)
+        ret['fetch_cache_max_bytes'] = int(getattr(
+            settings, 'INFLUXDB_FETCH_CACHE_MAX_BYTES', 0))
+        ret['fetch_cache_ttl'] = int(getattr(
+            settings, 'INFLUXDB_FETCH_CACHE_TTL', 10))
+        ret['fetch_cache_historical_ttl'] = int(getattr(
+            settings, 'INFLUXDB_FETCH_CACHE_HISTORICAL_TTL', 3600))
+        ret['incremental_fetch'] = _parse_bool(getattr(
+            settings, 'INFLUXDB_INCREMENTAL_FETCH', False))
+        ret['incremental_fetch_lag'] = int(getattr(
+            settings, 'INFLUXDB_INCREMENTAL_FETCH_LAG', 60))
+        ret['incremental_fetch_max_bytes'] = int(getattr(
+            settings, 'INFLUXDB_INCREMENTAL_FETCH_MAX_BYTES', 64 * 1024 * 1024))
+        ret['fetch_step_mode'] = getattr(
+            settings, 'INFLUXDB_FETCH_STEP_MODE', 'max')
+        ret['fetch_chunk_size'] = int(getattr(
+            settings, 'INFLUXDB_FETCH_CHUNK_SIZE', 1000))
+        ret['fetch_concurrency'] = int(getattr(
+            settings, 'INFLUXDB_FETCH_CONCURRENCY', 1))
+        ret['query_timeout'] = getattr(
+            settings, 'INFLUXDB_QUERY_TIMEOUT', None)
+        ret['fetch_streaming'] = _parse_bool(getattr(
+            settings, 'INFLUXDB_FETCH_STREAMING', False))
+        ret['fetch_stream_chunk_size'] = int(getattr(
+            settings, 'INFLUXDB_FETCH_STREAM_CHUNK_SIZE', 10000))
+        ret['max_data_points'] = int(getattr(
+            settings, 'INFLUXDB_MAX_DATA_POINTS', 0))
+        ret['rollups'] = getattr(settings, 'INFLUXDB_ROLLUPS', [])
+        ret['coalesce_requests'] = _parse_bool(getattr(
+            settings, 'INFLUXDB_COALESCE_REQUESTS', True))
+        ret['coalesce_timeout'] = float(getattr(
+            settings, 'INFLUXDB_COALESCE_TIMEOUT', 30))
+        ret['profile_sample_rate'] = float(getattr(
+            settings, 'INFLUXDB_PROFILE_SAMPLE_RATE', 0))
+        ret['profile_buffer_size'] = int(getattr(
+            settings, 'INFLUXDB_PROFILE_BUFFER_SIZE', 1000))
         ret['es_enabled'] = getattr(settings, 'ES_ENABLED', False)
         ret['es_index'] = getattr(settings, 'ES_INDEX', 'graphite_metrics2')
         ret['es_hosts'] = getattr(settings, 'ES_HOSTS', ['localhost:9200'])
         ret['es_field'] = getattr(settings, 'ES_FIELD', '_id')
+        ret['es_depth_field'] = getattr(settings, 'ES_DEPTH_FIELD', None)
+        ret['es_page_size'] = int(getattr(settings, 'ES_PAGE_SIZE', 10000))
+        ret['es_max_hits'] = int(getattr(settings, 'ES_MAX_HITS', 0))
+        ret['es_timeout'] = int(getattr(settings, 'ES_TIMEOUT', 10))
     return ret
 
-def _make_graphite_api_points_list(influxdb_data):
-    """Make graphite-api data points dictionary from Influxdb ResultSet data"""
-    _data = {}
-    for key in influxdb_data.keys():
-        _data[key[0]] = [(datetime.datetime.fromtimestamp(float(d['time'])),
-                          d['value']) for d in influxdb_data.get_points(key[0])]
-    return _data
+def _translate_glob(pattern):
+    """Turn a graphite glob into a regex string (without anchors).
+    Supports *, ?, [...] character classes (with ! or ^ negation) and {a,b} alternatives,
+    none of which match across a '.'. Everything else is matched literally.
+    Only uses syntax that python, influxdb and elasticsearch regexes have in common."""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            out.append('[^\\.]*')
+        elif c == '?':
+            out.append('[^\\.]')
+        elif c == '[':
+            # like fnmatch, a ] right after the [ (or its negation) is a member, not the end
+            j = pattern.find(']', i + 2 if i < n and pattern[i] in '!^' else i + 1)
+            if j == -1:
+                out.append('\\[')
+                continue
+            chars = pattern[i:j]
+            i = j + 1
+            negate = chars[:1] in ('!', '^')
+            if negate:
+                chars = chars[1:]
+            chars = chars.replace('\\', '\\\\').replace(']', '\\]')
+            out.append('[%s%s]' % ('^' if negate else '', chars))
+        elif c == '{':
+            j = pattern.find('}', i)
+            if j == -1:
+                out.append('\\{')
+                continue
+            alternatives = pattern[i:j].split(',')
+            i = j + 1
+            out.append('(%s)' % '|'.join(_translate_glob(alt) for alt in alternatives))
+        elif c in _REGEX_SPECIAL:
+            out.append('\\' + c)
+        else:
+            out.append(c)
+    return ''.join(out)
+
+
+class LRUCache(object):
+    """Thread safe mapping holding at most max_size entries, evicting the least recently used"""
+    __slots__ = ('max_size', 'entries', 'lock')
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+# compiled glob matchers and regexes, keyed by (fmt, pattern)
+_compiled_globs = LRUCache(4096)
+
+
+class Glob(object):
+    """A compiled graphite glob.
+    Patterns without glob characters are matched by equality, and patterns that are a literal
+    prefix followed by a single trailing * by a startswith check. Only the others use a regex."""
+    __slots__ = ('pattern', 'prefix', 'regex')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        glob = _GLOB_CHARS.search(pattern)
+        # everything up to the first glob character must be matched literally
+        self.prefix = pattern if glob is None else pattern[:glob.start()]
+        self.regex = None
+        if glob is not None and not (glob.start() == len(pattern) - 1 and pattern[-1] == '*'):
+            self.regex = re.compile(_translate_glob(pattern) + '$')
+
+    @property
+    def is_literal(self):
+        return self.prefix == self.pattern
+
+    @property
+    def is_prefix(self):
+        return self.regex is None and self.prefix != self.pattern
+
+    def __call__(self, name):
+        if self.regex is not None:
+            return self.regex.match(name) is not None
+        if self.prefix == self.pattern:
+            return name == self.pattern
+        return name.startswith(self.prefix) and name.find('.', len(self.prefix)) == -1
+
+    def filter(self, names):
+        """Return the names matching the glob"""
+        if self.regex is not None:
+            match = self.regex.match
+            return [name for name in names if match(name)]
+        if self.prefix == self.pattern:
+            pattern = self.pattern
+            return [name for name in names if name == pattern]
+        prefix, prefix_len = self.prefix, len(self.prefix)
+        return [name for name in names if name.startswith(prefix) and name.find('.', prefix_len) == -1]
+
+
+def compile_glob(pattern):
+    """Return the (memoized) Glob for a graphite glob pattern"""
+    key = (None, pattern)
+    glob = _compiled_globs.get(key)
+    if glob is None:
+        glob = Glob(pattern)
+        _compiled_globs.put(key, glob)
+    return glob
+
+
+def compile_glob_regex(fmt, pattern):
+    """Turn a graphite glob into a compiled (memoized) regex.
+    fmt is so that callers can control anchoring (must contain exactly 1 {0} !)"""
+    key = (fmt, pattern)
+    regex = _compiled_globs.get(key)
+    if regex is None:
+        regex = re.compile(fmt.format(_translate_glob(pattern)))
+        _compiled_globs.put(key, regex)
+    return regex
+
+
+def _match_leaves_and_branches(names, pattern):
+    """Return the names matching pattern, and the branches (prefixes of names) matching it,
+    from a single pass over names"""
+    glob = compile_glob(pattern)
+    # '*' and friends don't match '.', so every leaf has exactly as many nodes as
+    # the pattern, and every branch is the first nodes of a longer series name.
+    depth = pattern.count('.') + 1
+    leaves = []
+    branches = []
+    seen_branches = set()
+    # names not starting with the literal prefix of the glob can't match,
+    # which lets us discard most of them without any further work
+    literal_prefix = glob.prefix
+    for name in names:
+        if not name.startswith(literal_prefix):
+            continue
+        parts = name.split('.', depth)
+        if len(parts) == depth:
+            leaves.append(name)
+        elif len(parts) > depth:
+            branch = name[:-len(parts[-1]) - 1]
+            if branch not in seen_branches:
+                seen_branches.add(branch)
+                branches.append(branch)
+    # for a literal prefix followed by a trailing *, having the prefix and
+    # the right number of nodes is all it takes to match
+    if not glob.is_prefix:
+        leaves = glob.filter(leaves)
+        branches = glob.filter(branches)
+    return leaves, branches
+
+
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400, 'y': 365 * 86400}
+
+
+def _parse_duration(value):
+    """Parse a duration in seconds, either a number or a string like '7d' (s, m, h, d, w or y).
+    0 or None mean forever."""
+    if not value:
+        return None
+    if isinstance(value, (int, float)) or value[-1] not in _DURATION_UNITS:
+        return int(value)
+    return int(value[:-1]) * _DURATION_UNITS[value[-1]]
+
+
+def _parse_resolution(spec):
+    """Parse the resolution of a schema rule into (step, tiers).
+    spec is either a step, or a list of [retention policy, step, max age] tiers,
+    which are returned as (retention policy, step, max age) tuples, finest step first."""
+    if not isinstance(spec, (list, tuple)):
+        return spec, None
+    tiers = tuple(sorted(((retention_policy, int(step), _parse_duration(max_age))
+                          for (retention_policy, step, max_age) in spec), key=lambda tier: tier[1]))
+    return tiers[0][1], tiers
+
+
+def _covering_tier(tiers, start_time, now):
+    """Return the finest tier that still has data for start_time,
+    or the one with the longest retention if none does"""
+    for tier in tiers:
+        if not tier[2] or now - tier[2] <= start_time:
+            return tier
+    return max(tiers, key=lambda tier: tier[2])
+
+
+def _tiers_coverage(tiers):
+    """Return how far back (in seconds) any of the tiers has data, or None if forever"""
+    if not tiers or any(not tier[2] for tier in tiers):
+        return None
+    return max(tier[2] for tier in tiers)
+
+
+def _tier_route(tiers, step, start_time, now):
+    """Return (retention policy, recent retention policy, split) to read buckets of step seconds
+    of a series with the given tiers from.
+
+    That's the cheapest (coarsest) tier that can be aggregated into such buckets and still has
+    data for start_time.  Rollups are written with a delay, so when that's not the finest tier,
+    the buckets from split on are read from the finest one instead.
+    The recent retention policy and split are None when everything is read from a single tier."""
+    usable = [tier for tier in tiers if step % tier[1] == 0] or [tiers[0]]
+    covering = [tier for tier in usable if not tier[2] or now - tier[2] <= start_time]
+    tier = covering[-1] if covering else max(usable, key=lambda tier: tier[2])
+    finest = usable[0]
+    if tier is finest:
+        return tier[0], None, None
+    split = now - 2 * tier[1]
+    split -= split % step
+    if split <= start_time:
+        return finest[0], None, None
+    return tier[0], finest[0], split
+
+
+class StepResolver(object):
+    """Resolves the step of a series from the configured schema:
+    the first pattern that matches the name wins, falling back to 60 seconds.
+    A rule either has a single step, or a list of retention policy tiers (see get_tiers).
+
+    All patterns are combined into a single alternation regex with a named group per
+    pattern, so a name is resolved with a single match rather than trying every pattern
+    in turn. Resolved steps are memoized per name."""
+    __slots__ = ('schemas', 'rules', 'regex', 'resolutions', 'cache', 'cache_size', 'default')
+
+    def __init__(self, schema, default=60, cache_size=100000):
+        self.rules = [(re.compile(patt), _parse_resolution(spec)) for (patt, spec) in schema]
+        self.schemas = [(patt, resolution[0]) for (patt, resolution) in self.rules]
+        self.default = (default, None)
+        self.resolutions = {}
+        self.regex = None
+        # backreferences would refer to the wrong groups once the patterns are combined,
+        # and inline flags such as (?i) would apply to all patterns rather than their own
+        if self.rules and not any(re.search(r'\\\d|\(\?P=|\(\?[aiLmsux]+\)', patt) for (patt, _) in schema):
+            try:
+                self.regex = re.compile('|'.join('(?P<_schema%d>%s)' % (i, patt)
+                                                 for (i, (patt, _)) in enumerate(schema)))
+            except re.error:
+                pass
+            else:
+                self.resolutions = dict(('_schema%d' % i, resolution)
+                                        for (i, (_, resolution)) in enumerate(self.rules))
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def resolve(self, name):
+        """Return (step, tiers) for name, tiers being None for rules with a single step"""
+        resolution = self.cache.get(name)
+        if resolution is not None:
+            return resolution
+        if self.regex is not None:
+            match = self.regex.match(name)
+            resolution = self.resolutions[match.lastgroup] if match else self.default
+        else:
+            resolution = next((res for (patt, res) in self.rules if patt.match(name)), self.default)
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[name] = resolution
+        return resolution
+
+    def get_step(self, name):
+        """Return the step of name, for tiered rules that of the finest tier"""
+        return self.resolve(name)[0]
+
+    def get_tiers(self, name):
+        """Return the (retention policy, step, max age) tiers of name, finest first,
+        or None if its rule has a single step"""
+        return self.resolve(name)[1]
+
+
+class SeriesIndex(object):
+    """In-memory prefix trie of all series names, shared by every finder in the
+    process that talks to the same database.
+
+    To keep the trie compact, a node is a plain dict mapping an (interned) path
+    segment to its child node. Leaves without children - the vast majority of
+    nodes - are stored as None rather than an empty dict, and a node that is a
+    leaf as well as a branch carries a None key."""
+    __slots__ = ('root', 'size', 'built_at', 'lock', 'refreshing', 'attempted_at')
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+        self.built_at = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.attempted_at = 0
+
+    @staticmethod
+    def build(names):
+        """Build a trie from an iterable of series names, return (root, size)"""
+        root = {}
+        size = 0
+        for name in names:
+            parts = name.split('.')
+            node = root
+            for part in parts[:-1]:
+                part = _intern(part)
+                child = node.get(part)
+                if child is None:
+                    # either a new branch, or a leaf that turns out to be a branch as well
+                    child = {None: None} if part in node else {}
+                    node[part] = child
+                node = child
+            last = _intern(parts[-1])
+            if last not in node:
+                node[last] = None
+            elif node[last] is not None:
+                node[last][None] = None
+            size += 1
+        return root, size
+
+    def refresh(self, list_series):
+        """Rebuild the trie from list_series() and swap it in.
+        Readers keep using the old trie until the new one is complete."""
+        try:
+            root, size = self.build(list_series())
+            self.root, self.size = root, size
+            self.built_at = time.time()
+        except Exception:
+            self.attempted_at = time.time()
+            raise
+        finally:
+            self.refreshing = False
+
+    def _refresh_in_background(self, list_series):
+        try:
+            self.refresh(list_series)
+        except Exception as e:
+            logger.error("Could not refresh the series index, keeping the one of %d series: %s", self.size, e)
+
+    def maybe_refresh(self, list_series, interval):
+        """Make sure the trie is populated and not older than interval seconds.
+        The first build blocks and raises what list_series raises, later refreshes happen
+        in a background thread.  After a failed build or refresh, the next one is attempted
+        a minute (or interval) later."""
+        if self.built_at is None:
+            with self.lock:
+                if self.built_at is None and time.time() - self.attempted_at >= min(interval, 60):
+                    self.refresh(list_series)
+            return
+        if time.time() - self.built_at < interval:
+            return
+        with self.lock:
+            if self.refreshing or time.time() - self.attempted_at < min(interval, 60):
+                return
+            self.refreshing = True
+        thread = threading.Thread(target=self._refresh_in_background, args=(list_series,),
+                                  name='graphite_influxdb-index-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def find(self, pattern):
+        """Resolve a graphite glob against the trie, one path segment at a time.
+        Returns (leaves, branches) from a single traversal."""
+        matches = [('', self.root)]
+        for segment in pattern.split('.'):
+            if not _GLOB_CHARS.search(segment):
+                matches = [(prefix + segment, node[segment])
+                           for (prefix, node) in matches
+                           if node and segment in node]
+            else:
+                glob = compile_glob(segment)
+                matches = [(prefix + key, node[key])
+                           for (prefix, node) in matches if node
+                           for key in glob.filter([key for key in node if key is not None])]
+            matches = [(path + '.', node) for (path, node) in matches]
+        leaves, branches = [], []
+        for (path, node) in matches:
+            path = path[:-1]
+            if node is None or None in node:
+                leaves.append(path)
+            if node and (len(node) > 1 or None not in node):
+                branches.append(path)
+        return leaves, branches
+
+
+class _Flight(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key: the first caller runs the function,
+    and callers arriving while it's in flight wait for it and share its result (or exception).
+    Waiters give up after timeout seconds and run the function themselves."""
+    __slots__ = ('flights', 'lock', 'timeout')
+
+    def __init__(self, timeout=None):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.timeout = timeout
+
+    def do(self, key, func, *args):
+        """Return (result of func(*args), whether it came from a call of another thread)"""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+        if not leader:
+            if flight.done.wait(self.timeout):
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result, True
+            logger.warning("Gave up waiting %ss for concurrent request %s, running it again", self.timeout, key)
+            return func(*args), False
+        try:
+            flight.result = func(*args)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, False
+
+
+class FetchCache(object):
+    """LRU cache bounded by the (estimated) byte size of its entries.
+    Every entry has its own expiry time, so recent data can be cached shorter
+    than data that won't change anymore."""
+    __slots__ = ('max_bytes', 'bytes', 'entries', 'lock')
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # key -> (expires, size, value), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self.bytes -= entry[1]
+                return None
+            self.entries[key] = entry
+            return entry[2]
+
+    def put(self, key, value, size, ttl):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (time.time() + ttl, size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, old_size, _) = self.entries.popitem(last=False)
+                self.bytes -= old_size
+
+
+def _values_size(values):
+    """Rough memory footprint in bytes of a list of values: a slot of 8 bytes per value,
+    and a float of 24 bytes per value that isn't None"""
+    return 64 + 8 * len(values) + 24 * (len(values) - values.count(None))
+
+
+def _estimate_size(data):
+    """Rough memory footprint in bytes of a fetch_multi result dict"""
+    return sum(64 + len(key) + _values_size(values) for (key, values) in data.items())
+
+
+# one SeriesIndex per (host, port, db), shared by all finders in the process
+_series_indexes = {}
+_series_indexes_lock = threading.Lock()
+
+
+def get_series_index(key):
+    with _series_indexes_lock:
+        index = _series_indexes.get(key)
+        if index is None:
+            index = _series_indexes[key] = SeriesIndex()
+        return index
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler(sample_rate, size):
+    """Return the profiler shared by all finders in the process (a NullProfiler if sample_rate is 0),
+    so the samples of all of them end up in the same ring buffer"""
+    global _profiler
+    if sample_rate <= 0:
+        return NullProfiler()
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = Profiler(sample_rate, size)
+        return _profiler
+
+
+def recent_profiles():
+    """Return the breakdowns of the most recently profiled finds and fetches, oldest first"""
+    if _profiler is None:
+        return []
+    return [profile.as_dict() for profile in list(_profiler.samples)]
+
+
+def _read_buckets(raw, first_bucket, num_buckets, step):
+    """Read the series of a raw influxdb response into a dict of name -> list of num_buckets
+    values, placing every point by its timestamp so gaps come back as None.
+
+    No per point objects get created: when influxdb
+    returned exactly the requested buckets (the usual case, as it fills empty ones with null),
+    the values are copied out in one go, otherwise they are placed by timestamp."""
+    data = {}
+    last_bucket = first_bucket + (num_buckets - 1) * step
+    for series in raw.get('series', []):
+        rows = series['values']
+        if series['columns'] == ['time', 'value'] and len(rows) == num_buckets and \
+                rows[0][0] == first_bucket and rows[-1][0] == last_bucket:
+            data[series['name']] = [value for (_, value) in rows]
+            continue
+        values = [None] * num_buckets
+        _fill_buckets(values, series, first_bucket, step)
+        data[series['name']] = values
+    return data
+
+
+def _fill_buckets(values, series, first_bucket, step):
+    """Place the points of a raw influxdb series into values, by timestamp"""
+    if series['columns'] == ['time', 'value']:
+        time_index, value_index = 0, 1
+    else:
+        time_index = series['columns'].index('time')
+        value_index = series['columns'].index('value')
+    num_buckets = len(values)
+    for row in series['values']:
+        i = (row[time_index] - first_bucket) // step
+        if 0 <= i < num_buckets:
+            values[i] = row[value_index]
+
+
+def _iter_chunked_buckets(chunks, first_bucket, num_buckets, step):
+    """Assemble the series of a chunked influxdb response (an iterable of ResultSets)
+    into lists of num_buckets values, yielding (name, values) as soon as a series is complete.
+    A series may be spread over several chunks, all but the last of them marked partial."""
+    name = values = None
+    for chunk in chunks:
+        for series in chunk.raw.get('series', []):
+            if series['name'] != name:
+                if name is not None:
+                    yield name, values
+                name, values = series['name'], [None] * num_buckets
+            _fill_buckets(values, series, first_bucket, step)
+            if not series.get('partial'):
+                yield name, values
+                name = None
+    if name is not None:
+        yield name, values
+
+
+def _upsample(values, start_time, end_time, step, new_step):
+    """Repeat the values of buckets of step seconds so there's one per bucket of new_step
+    seconds, new_step being a divisor of step"""
+    if not values:
+        return values
+    first = start_time - start_time % step
+    new_first = start_time - start_time % new_step
+    num_buckets = (end_time - end_time % new_step - new_first) // new_step + 1
+    return [values[(bucket - bucket % step - first) // step]
+            for bucket in range(new_first, new_first + num_buckets * new_step, new_step)]
+
+
+_SNAPSHOT_HEADER = struct.Struct('<8sQ')
+_SNAPSHOT_MAGIC = b'GISNAP01'
+_SNAPSHOT_OFFSETS = struct.Struct('<QQ')
+_SNAPSHOT_STEP = struct.Struct('<I')
+
+
+class SeriesSnapshot(object):
+    """Read-only, memory mapped snapshot of all series names and their steps.
+
+    The file is a sorted string table: a header with the number of series, a table of
+    offsets (one more than the number of series) into the names blob, a table of steps,
+    and the utf-8 encoded names, sorted, back to back. Being mapped read-only, the pages
+    are shared by all processes using the same snapshot."""
+    __slots__ = ('mtime', 'size', 'buf', 'steps_at', 'names_at')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = _SNAPSHOT_HEADER.unpack_from(self.buf, 0)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError("%s is not a series snapshot" % path)
+        self.steps_at = _SNAPSHOT_HEADER.size + 8 * (self.size + 1)
+        self.names_at = self.steps_at + _SNAPSHOT_STEP.size * self.size
+
+    @staticmethod
+    def write(path, series):
+        """Write an iterable of (name, step) to a snapshot at path, atomically replacing it"""
+        series = sorted((name.encode('utf-8'), step) for (name, step) in series)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, len(series)))
+            offset = 0
+            for (name, _) in series:
+                f.write(struct.pack('<Q', offset))
+                offset += len(name)
+            f.write(struct.pack('<Q', offset))
+            for (_, step) in series:
+                f.write(_SNAPSHOT_STEP.pack(step))
+            for (name, _) in series:
+                f.write(name)
+        os.rename(tmp_path, path)
+
+    def _name(self, i):
+        start, end = _SNAPSHOT_OFFSETS.unpack_from(self.buf, _SNAPSHOT_HEADER.size + 8 * i)
+        return self.buf[self.names_at + start:self.names_at + end]
+
+    def _step(self, i):
+        return _SNAPSHOT_STEP.unpack_from(self.buf, self.steps_at + _SNAPSHOT_STEP.size * i)[0]
+
+    def _bisect(self, prefix):
+        """Index of the first name that is not lower than prefix"""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def iter_prefix(self, prefix):
+        """Yield (name, step) of all series starting with prefix"""
+        prefix = prefix.encode('utf-8')
+        for i in range(self._bisect(prefix), self.size):
+            name = self._name(i)
+            if not name.startswith(prefix):
+                break
+            yield name.decode('utf-8'), self._step(i)
+
+    def find(self, pattern):
+        """Return (leaves, branches) matching pattern, leaves being (name, step) tuples"""
+        series = list(self.iter_prefix(compile_glob(pattern).prefix))
+        leaves, branches = _match_leaves_and_branches([name for (name, _) in series], pattern)
+        steps = dict(series)
+        return [(name, steps[name]) for name in leaves], branches
+
+
+class SnapshotIndex(object):
+    """Keeps the current SeriesSnapshot at path open, reopening it when it gets replaced
+    on disk, and rebuilds it in the background when it gets too old.
+    Only one process at a time rebuilds a snapshot (where fcntl locks are available)."""
+    __slots__ = ('path', 'snapshot', 'lock', 'refreshing', 'attempted_at')
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.attempted_at = 0
+
+    def get(self, list_series, interval):
+        """Return the current snapshot, or None if there is none yet.
+        list_series() must return (name, step) tuples for all series."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is None or time.time() - mtime >= interval:
+            self.maybe_refresh(list_series, min(interval, 60))
+        if mtime is None:
+            return None
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.mtime != mtime:
+            with self.lock:
+                try:
+                    snapshot = self.snapshot = SeriesSnapshot(self.path)
+                except (IOError, OSError, ValueError, struct.error) as e:
+                    logger.error("Could not load series snapshot %s: %s", self.path, e)
+                    return None
+        return snapshot
+
+    def maybe_refresh(self, list_series, retry_interval):
+        with self.lock:
+            if self.refreshing or time.time() - self.attempted_at < retry_interval:
+                return
+            self.refreshing = True
+            self.attempted_at = time.time()
+        thread = threading.Thread(target=self.refresh, args=(list_series,),
+                                  name='graphite_influxdb-snapshot-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self, list_series):
+        try:
+            with open(self.path + '.lock', 'a') as lock_file:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except (IOError, OSError):
+                        # another process is rebuilding it
+                        return
+                SeriesSnapshot.write(self.path, list_series())
+        except Exception as e:
+            logger.error("Could not write series snapshot %s: %s", self.path, e)
+        finally:
+            self.refreshing = False
+
+
+_snapshot_indexes = {}
+
+
+def get_snapshot_index(path):
+    with _series_indexes_lock:
+        index = _snapshot_indexes.get(path)
+        if index is None:
+            index = _snapshot_indexes[path] = SnapshotIndex(path)
+        return index
+
+
+def _es_hit_value(hit, field):
+    value = hit['fields'][field]
+    # fields are returned as lists by ES 1.0 and up
+    return value[0] if isinstance(value, list) else value
+
+
+def _lcm(a, b):
+    return a * b // gcd(a, b)
+
+
+def _series_names(ret):
+    """Return the series names of the result of a show series query"""
+    # as long as influxdb doesn't have good safeguards against
+    # series with bad data in the metric names, we must filter out
+    # like so:
+    return [key_name for [key_name] in ret.raw['series'][0]['values']] \
+        if ret.raw.get('series') else []
+
+
+def _datapoints_query(paths, start_time, end_time, step, retention_policy=None, where=None):
+    """Return the query for the mean per step of all series in paths"""
+    if retention_policy:
+        series = ', '.join(['"%s"."%s"' % (retention_policy, path) for path in paths])
+    else:
+        series = ', '.join(['"%s"' % path for path in paths])
+    if where is None:
+        where = 'time > %ds and time <= %ds' % (start_time, end_time)
+    return 'select mean(value) as value from %s where (%s) GROUP BY time(%ss)' % (
+        series, where, step)
+
+
+def _fill_missing(data, paths):
+    """Add an empty list for every path without data"""
+    # some series we requested might not be in the resultset.
+    # this is because influx doesn't include series that had no values
+    # this is a behavior that some people actually appreciate when graphing, but graphite doesn't do this (yet),
+    # and we want to look the same, so we must add those back in.
+    # a better reason though, is because for advanced alerting cases like bosun, you want all entries even if they have no data, so you can properly
+    # compare, join, or do logic with the targets returned for requests for the same data but from different time ranges, you want them to all
+    # include the same keys.
+    for key in paths:
+        data.setdefault(key, [])
+
+
+def _join_stitched(paths, old_data, recent_data, start_time, end_time, step, split):
+    """Join the values of the buckets before split with those of the buckets from split on"""
+    num_old = (split - (start_time - start_time % step)) // step
+    num_recent = (end_time - end_time % step - split) // step + 1
+    data = {}
+    for path in paths:
+        values = old_data.get(path, [None] * num_old) + recent_data.get(path, [None] * num_recent)
+        data[path] = values if any(v is not None for v in values) else []
+    return data
+
+
+def _fetch_key(paths, step, start_time, end_time):
+    """Key identifying the result of fetching paths at step, for the fetch cache"""
+    # influxdb returns the same buckets for any start/end within them,
+    # so align on step boundaries to let near-identical windows share cache entries
+    return (frozenset(paths), step, start_time - start_time % step, end_time - end_time % step)
+
+
+def _coalesce_key(paths, step, start_time, end_time, groups):
+    """Key identifying a fetch, for coalescing identical ones that are in flight.
+    Unlike the cache, fetches only share a query for exactly the same window and routes,
+    as a query for an overlapping window has different first and last buckets."""
+    return ('fetch', frozenset(paths), step, start_time, end_time, frozenset(groups))
+
 
 class InfluxdbReader(object):
-    __slots__ = ('client', 'path', 'step', 'statsd_client')
+    __slots__ = ('client', 'path', 'step', 'statsd_client', 'tiers')
 
-    def __init__(self, client, path, step, statsd_client):
+    def __init__(self, client, path, step, statsd_client, tiers=None):
         self.client = client
         self.path = path
         self.step = step
         self.statsd_client = statsd_client
+        self.tiers = tiers
 
     def fetch(self, start_time, end_time):
         # in graphite,
         # from is exclusive (from=foo returns data at ts=foo+1 and higher)
         # until is inclusive (until=bar returns data at ts=bar and lower)
         # influx doesn't support <= and >= yet, hence the add.
-        logger.debug("fetch() path=%s start_time=%s, end_time=%s, step=%d", self.path, start_time, end_time, self.step)
+        step = self.step
+        logger.debug("fetch() path=%s start_time=%s, end_time=%s, step=%d", self.path, start_time, end_time, step)
         with self.statsd_client.timer('service_is_graphite-api.ext_service_is_influxdb.target_type_is_gauge.unit_is_ms.what_is_query_individual_duration'):
-            _query = 'select mean(value) as value from "%s" where (time > %ds and time <= %ds) GROUP BY time(%ss)' % (
-                self.path, start_time, end_time, self.step)
-            logger.debug("fetch() path=%s querying influxdb query: '%s'", self.path, _query)
-            data = self.client.query(_query, params=_INFLUXDB_CLIENT_PARAMS)
+            if not self.tiers:
+                data = self._query(start_time, end_time, step)
+            else:
+                # like fetch_multi, read from the finest tier with data for start_time, or a cheaper
+                # one, with the buckets the rollups don't have yet from the finest tier
+                now = int(time.time())
+                step = _covering_tier(self.tiers, start_time, now)[1]
+                (retention_policy, recent_policy, split) = _tier_route(self.tiers, step, start_time, now)
+                if recent_policy is not None and split <= end_time:
+                    old_data = self._query(start_time, split - step, step, retention_policy,
+                                           where='time > %ds and time < %ds' % (start_time, split))
+                    recent_data = self._query(split, end_time, step, recent_policy,
+                                              where='time >= %ds and time <= %ds' % (split, end_time))
+                    data = _join_stitched([self.path], old_data, recent_data, start_time, end_time, step, split)
+                else:
+                    data = self._query(start_time, end_time, step, retention_policy)
+        time_info = start_time, end_time, step
+        return time_info, data.get(self.path, [])
+
+    def _query(self, start_time, end_time, step, retention_policy=None, where=None):
+        _query = _datapoints_query([self.path], start_time, end_time, step, retention_policy, where)
+        logger.debug("fetch() path=%s querying influxdb query: '%s'", self.path, _query)
+        data = self.client.query(_query, params=_INFLUXDB_CLIENT_PARAMS)
         logger.debug("fetch() path=%s returned data: %s", self.path, data)
+        first_bucket = start_time - start_time % step
         try:
-            data = _make_graphite_api_points_list(data)
+            return _read_buckets(data.raw, first_bucket,
+                                 (end_time - end_time % step - first_bucket) // step + 1, step)
         except Exception:
             logger.debug("fetch() path=%s COULDN'T READ POINTS. SETTING TO EMPTY LIST", self.path)
-            data = []
-        time_info = start_time, end_time, self.step
-        return time_info, [v[1] for v in data[self.path]]
-    
+            return {}
+
     def get_intervals(self):
         now = int(time.time())
-        return IntervalSet([Interval(1, now)])
+        coverage = _tiers_coverage(self.tiers)
+        return IntervalSet([Interval(now - coverage if coverage else 1, now)])
 
 
 class InfluxLeafNode(LeafNode):
     __fetch_multi__ = 'influxdb'
+    __slots__ = ()
+
+
+class CompactLeafNode(InfluxLeafNode):
+    """Leaf node that is its own reader, so finds yielding many nodes create a single object per series.
+
+    Rather than a reader holding the client, statsd client and path, and an IntervalSet of its own,
+    a node refers to the finder (the context shared by all its nodes) and to the step and tiers
+    of its schema rule, which all series of the rule share.  Names are interned."""
+    __slots__ = ('finder', 'step', 'tiers')
+
+    def __init__(self, path, finder, step, tiers=None):
+        self.path = path
+        self.name = _intern(path[path.rfind('.') + 1:])
+        self.local = True
+        self.is_leaf = True
+        self.finder = finder
+        self.step = step
+        self.tiers = tiers
+
+    @property
+    def reader(self):
+        return self
+
+    @property
+    def intervals(self):
+        return self.get_intervals()
+
+    def fetch(self, start_time, end_time):
+        return InfluxdbReader(self.finder.client, self.path, self.step, self.finder.statsd_client,
+                              self.tiers).fetch(start_time, end_time)
+
+    def get_intervals(self):
+        return self.finder.get_intervals(_tiers_coverage(self.tiers))
+
+    def __repr__(self):
+        return '<CompactLeafNode[%x]: %s (step %s)>' % (id(self), self.path, self.step)
 
 
 class InfluxdbFinder(object):
     __fetch_multi__ = 'influxdb'
-    __slots__ = ('client', 'es', 'schemas', 'config', 'statsd_client')
+    __slots__ = ('client', 'es', 'schemas', 'step_resolver', 'config', 'statsd_client', 'fetch_cache',
+                 'fetch_history', 'executor', 'singleflight', 'profiler', 'intervals')
 
     def __init__(self, config=None):
         # Shouldn't be trying imports in __init__.
         # It turns what should be a load error into a runtime error
         config = normalize_config(config)
         self.config = config
-        self.client = InfluxDBClient(config['host'], config['port'], config['user'], config['passw'], config['db'], config['ssl'])
-        self.schemas = [(re.compile(patt), step) for (patt, step) in config['schema']]
+        client_kwargs = {'timeout': config['query_timeout']}
+        if config['fetch_concurrency'] > 1:
+            # keep a connection alive for every concurrent query
+            client_kwargs['pool_size'] = config['fetch_concurrency']
+        self.client = InfluxDBClient(config['host'], config['port'], config['user'], config['passw'], config['db'], config['ssl'],
+                                     **client_kwargs)
+        self.step_resolver = StepResolver(config['schema'])
+        self.schemas = self.step_resolver.schemas
         try:
             self.statsd_client = statsd.StatsClient(config['statsd'].get('host'),
                                                     config['statsd'].get('port', 8125)) \
@@ -162,6 +1253,23 @@ class InfluxdbFinder(object):
                                "module not installed - ignoring elasticsearch configuration..")
             else:
                 self.es = Elasticsearch(config['es_hosts'])
+        self.fetch_cache = FetchCache(config['fetch_cache_max_bytes']) \
+            if config['fetch_cache_max_bytes'] > 0 else None
+        self.fetch_history = FetchCache(config['incremental_fetch_max_bytes']) \
+            if config['incremental_fetch'] else None
+        # coverage -> (time, IntervalSet), shared by all nodes with the same coverage
+        self.intervals = {}
+        self.profiler = get_profiler(config['profile_sample_rate'], config['profile_buffer_size'])
+        # identical finds and fetches running at the same time in several threads share one query
+        self.singleflight = SingleFlight(config['coalesce_timeout']) if config['coalesce_requests'] else None
+        self.executor = None
+        if config['fetch_concurrency'] > 1:
+            try:
+                # the pool size caps the number of queries this finder has in flight
+                self.executor = ThreadPoolExecutor(max_workers=config['fetch_concurrency'])
+            except NameError:
+                logger.warning("Fetch concurrency configured but 'concurrent.futures' module"
+                               "not installed (pip install futures) - fetching serially..")
 
     def _setup_logger(self, level, log_file):
         """Setup log level and log file if set"""
@@ -186,146 +1294,529 @@ class InfluxdbFinder(object):
             handler.setFormatter(formatter)
 
     def assure_series(self, query):
-        key_series = "%s_series" % query.pattern
-        done = False
+        with self.profiler.phase('list_series'):
+            if self.singleflight is None:
+                series = self._lookup_series(query)
+            else:
+                series, coalesced = self.singleflight.do(('series', query.pattern), self._lookup_series, query)
+                if coalesced:
+                    self.statsd_client.incr('service_is_graphite-api.target_type_is_count.unit_is_req.action_is_coalesced_series_lookup')
+                    self.profiler.count('coalesced')
+                    series = list(series)
+        self.profiler.count('series', len(series))
+        return series
+
+    def _lookup_series(self, query):
+        series = None
         if self.es:
-            # note: ES always treats a regex as anchored at start and end
-            regex = self.compile_regex('{0}.*', query)
-            with self.statsd_client.timer('service_is_graphite-api.ext_service_is_elasticsearch.target_type_is_gauge.unit_is_ms.action_is_get_series'):
-                logger.debug("assure_series() Calling ES with regexp - %s", regex.pattern)
-                try:
-                    res = self.es.search(index=self.config['es_index'],
-                                         size=10000,
-                                         body={
-                                             "query": {
-                                                 "regexp": {
-                                                     self.config['es_field']: regex.pattern,
-                                                 },
-                                             },
-                                             "fields": [self.config['es_field']]
-                                         }
-                                         )
-                    if res['_shards']['successful'] > 0:
-                        # pprint(res['hits']['total'])
-                        series = [hit['fields'][self.config['es_field']] for hit in res['hits']['hits']]
-                        done = True
-                    else:
-                        logger.error("assure_series() Calling ES failed for %s: no successful shards", regex.pattern)
-                except Exception as e:
-                    logger.error("assure_series() Calling ES failed for %s: %s", regex.pattern, e)
+            series = self._es_series(query)
         # if no ES configured, or ES failed, try influxdb.
-        if not done:
-            # regexes in influxdb are not assumed to be anchored, so anchor them explicitly
-            regex = self.compile_regex('^{0}', query)
+        if series is None:
             with self.statsd_client.timer('service_is_graphite-api.ext_service_is_influxdb.target_type_is_gauge.unit_is_ms.action_is_get_series'):
-                _query = "show series from /%s/" % regex.pattern
+                _query = self._series_query(query)
                 logger.debug("assure_series() Calling influxdb with query - %s", _query)
-                ret = self.client.query(_query, params=_INFLUXDB_CLIENT_PARAMS)
-                # as long as influxdb doesn't have good safeguards against
-                # series with bad data in the metric names, we must filter out
-                # like so:
-                series = [key_name for [key_name] in  ret.raw['series'][0]['values']]
+                series = _series_names(self.client.query(_query, params=_INFLUXDB_CLIENT_PARAMS))
+        return series
+
+    def _series_query(self, query):
+        # regexes in influxdb are not assumed to be anchored, so anchor them explicitly
+        return "show series from /%s/" % self.compile_regex('^{0}', query).pattern
+
+    def _es_query(self, pattern):
+        """Build the ES query for all series matching pattern, or starting with a match of it.
+        Uses term/prefix queries wherever the glob allows, as those are much cheaper than regexps"""
+        field = self.config['es_field']
+        depth_field = self.config['es_depth_field']
+        # alternatives containing a '.' span several nodes and can't be split up
+        if depth_field and not re.search(r'\{[^}]*\.', pattern):
+            # one clause per node, on fields holding the nodes of the name by position
+            clauses = []
+            for (i, segment) in enumerate(pattern.split('.')):
+                glob = compile_glob(segment)
+                if glob.is_literal:
+                    clauses.append({"term": {depth_field.format(i): segment}})
+                elif glob.is_prefix:
+                    if glob.prefix:
+                        clauses.append({"prefix": {depth_field.format(i): glob.prefix}})
+                    else:
+                        clauses.append({"exists": {"field": depth_field.format(i)}})
+                else:
+                    # note: ES always treats a regex as anchored at start and end
+                    clauses.append({"regexp": {depth_field.format(i): _translate_glob(segment)}})
+            return {"bool": {"must": clauses}}
+        glob = compile_glob(pattern)
+        if glob.regex is None:
+            # every series matching the glob, or below a match, starts with its literal prefix
+            return {"prefix": {field: glob.prefix}}
+        # note: ES always treats a regex as anchored at start and end
+        return {"regexp": {field: compile_glob_regex('{0}.*', pattern).pattern}}
+
+    def _es_series(self, query):
+        """List the series for query from ES, paging through all results with a scroll.
+        Returns None when ES failed or timed out."""
+        field = self.config['es_field']
+        es_query = self._es_query(query.pattern)
+        max_hits = self.config['es_max_hits']
+        timeout = self.config['es_timeout']
+        series = []
+        scroll_id = None
+        with self.statsd_client.timer('service_is_graphite-api.ext_service_is_elasticsearch.target_type_is_gauge.unit_is_ms.action_is_get_series'):
+            logger.debug("assure_series() Calling ES with query - %s", es_query)
+            try:
+                res = self.es.search(index=self.config['es_index'],
+                                     size=self.config['es_page_size'],
+                                     scroll='%ds' % timeout,
+                                     request_timeout=timeout,
+                                     body={
+                                         "query": es_query,
+                                         "fields": [field]
+                                     }
+                                     )
+                if res['_shards']['successful'] == 0:
+                    logger.error("assure_series() Calling ES failed for %s: no successful shards", es_query)
+                    return None
+                while True:
+                    scroll_id = res.get('_scroll_id')
+                    hits = res['hits']['hits']
+                    series.extend(_es_hit_value(hit, field) for hit in hits)
+                    # read past max_hits, to tell a truncated lookup from one with exactly max_hits matches
+                    if not hits or not scroll_id or (max_hits and len(series) > max_hits):
+                        break
+                    res = self.es.scroll(scroll_id=scroll_id, scroll='%ds' % timeout,
+                                         request_timeout=timeout)
+            except Exception as e:
+                logger.error("assure_series() Calling ES failed for %s: %s", es_query, e)
+                return None
+            finally:
+                if scroll_id:
+                    try:
+                        self.es.clear_scroll(scroll_id=scroll_id)
+                    except Exception:
+                        pass
+        if max_hits and len(series) > max_hits:
+            logger.warning("assure_series() ES returned more than %d series for %s, truncating",
+                           max_hits, query.pattern)
+            self.statsd_client.incr('service_is_graphite-api.ext_service_is_elasticsearch.target_type_is_count.unit_is_req.what_is_truncated_series_lookup')
+            series = series[:max_hits]
         return series
 
+    def _list_all_series(self):
+        """List every series name in the database, used to (re)build the series index"""
+        with self.statsd_client.timer('service_is_graphite-api.ext_service_is_influxdb.target_type_is_gauge.unit_is_ms.action_is_list_all_series'):
+            ret = self.client.query("show series", params=_INFLUXDB_CLIENT_PARAMS)
+        if not ret.raw.get('series'):
+            return []
+        return [key_name for [key_name] in ret.raw['series'][0]['values']]
+
+    def get_series_index(self):
+        index = get_series_index((self.config['host'], self.config['port'], self.config['db']))
+        index.maybe_refresh(self._list_all_series, self.config['index_refresh_interval'])
+        return index
+
+    def find_in_index(self, query):
+        """Find leaves (with their resolution) and branches using the in-memory series index.
+        Returns None if the index couldn't be built (yet)."""
+        try:
+            index = self.get_series_index()
+        except Exception as e:
+            logger.error("Could not build the series index, listing matching series instead: %s", e)
+            return None
+        if index.built_at is None:
+            # the first build failed a moment ago, see SeriesIndex.maybe_refresh
+            return None
+        with self.profiler.phase('match'):
+            with self.statsd_client.timer('service_is_graphite-api.action_is_find_in_index.target_type_is_gauge.unit_is_ms'):
+                names, branches = index.find(query.pattern)
+            get_step = self.step_resolver.get_step
+            leaves = [(name, get_step(name)) for name in names]
+        logger.debug("find_in_index() %s - %d leaves, %d branches out of %d series",
+                     query.pattern, len(leaves), len(branches), index.size)
+        return leaves, branches
+
+    def find_in_snapshot(self, query):
+        """Find leaves (with their resolution) and branches using the on-disk series snapshot.
+        Returns None if there is no snapshot (yet)."""
+        snapshot = get_snapshot_index(self.config['index_snapshot_path']).get(
+            self._list_all_series_with_steps, self.config['index_refresh_interval'])
+        if snapshot is None:
+            return None
+        with self.profiler.phase('match'):
+            with self.statsd_client.timer('service_is_graphite-api.action_is_find_in_snapshot.target_type_is_gauge.unit_is_ms'):
+                leaves, branches = snapshot.find(query.pattern)
+        logger.debug("find_in_snapshot() %s - %d leaves, %d branches out of %d series",
+                     query.pattern, len(leaves), len(branches), snapshot.size)
+        return leaves, branches
+
+    def _list_all_series_with_steps(self):
+        get_step = self.step_resolver.get_step
+        return [(name, get_step(name)) for name in self._list_all_series()]
+
     def compile_regex(self, fmt, query):
         """Turn glob (graphite) queries into compiled regex
-        * becomes .*
-        . becomes \.
+        * becomes [^\\.]*
+        . becomes \\.
         fmt argument is so that caller can control anchoring (must contain exactly 1 {0} !"""
-        return re.compile(fmt.format(
-            query.pattern.replace('.', '\.').replace('*', '[^\.]*').replace(
-                '{', '(').replace(',', '|').replace('}', ')')
-        ))
+        return compile_glob_regex(fmt, query.pattern)
 
-    def get_leaves(self, query):
-        key_leaves = "%s_leaves" % query.pattern
-        series = self.assure_series(query)
-        regex = self.compile_regex('^{0}$', query)
-        logger.debug("get_leaves() key %s", key_leaves)
-        timer = self.statsd_client.timer('service_is_graphite-api.action_is_find_leaves.target_type_is_gauge.unit_is_ms')
-        now = datetime.datetime.now()
+    def get_leaves_and_branches(self, query):
+        """Return (leaves, branches) matching query from a single series listing and
+        a single pass over the names.
+        leaves is a list of (name, resolution) tuples, branches a list of names."""
+        return self.match_series(query, self.assure_series(query))
+
+    def match_series(self, query, series):
+        """Return (leaves, branches) like get_leaves_and_branches, from the given series names"""
+        key = "%s_leaves_and_branches" % query.pattern
+        logger.debug("get_leaves_and_branches() key %s", key)
+        timer = self.statsd_client.timer('service_is_graphite-api.action_is_find_leaves_and_branches.target_type_is_gauge.unit_is_ms')
+        start_time = time.time()
         timer.start()
-        # return every matching series and its
-        # resolution (based on first pattern match in schema, fallback to 60s)
-        leaves = [(name, next((res for (patt, res) in self.schemas if patt.match(name)), 60))
-                  for name in series if regex.match(name)
-                  ]
+        with self.profiler.phase('match'):
+            leaves, branches = _match_leaves_and_branches(series, query.pattern)
+            # resolution based on first pattern match in schema, fallback to 60s
+            get_step = self.step_resolver.get_step
+            leaves = [(name, get_step(name)) for name in leaves]
         timer.stop()
-        end = datetime.datetime.now()
-        dt = end - now
-        logger.debug("get_leaves() key %s Finished find_leaves in %s.%ss",
-                     key_leaves,
-                     dt.seconds,
-                     dt.microseconds)
-        return leaves
+        logger.debug("get_leaves_and_branches() key %s Finished in %.6fs - %d leaves, %d branches",
+                     key, time.time() - start_time, len(leaves), len(branches))
+        return leaves, branches
+
+    def get_leaves(self, query):
+        return self.get_leaves_and_branches(query)[0]
 
     def get_branches(self, query):
-        seen_branches = set()
-        key_branches = "%s_branches" % query.pattern
-        # Very inefficient call to list
-        series = self.assure_series(query)
-        regex = self.compile_regex('^{0}$', query)
-        logger.debug("get_branches() %s", key_branches)
-        timer = self.statsd_client.timer('service_is_graphite-api.action_is_find_branches.target_type_is_gauge.unit_is_ms')
-        start_time = datetime.datetime.now()
-        timer.start()
-        branches = []
-        for name in series:
-            while '.' in name:
-                name = name.rsplit('.', 1)[0]
-                if name not in seen_branches:
-                    seen_branches.add(name)
-                    if regex.match(name) is not None:
-                        logger.debug("get_branches() %s found branch name: %s", key_branches, name)
-                        branches.append(name)
-        timer.stop()
-        end_time = datetime.datetime.now()
-        dt = end_time - start_time
-        logger.debug("get_branches() %s Finished find_branches in %s.%ss",
-                     key_branches,
-                     dt.seconds, dt.microseconds)
-        return branches
+        return self.get_leaves_and_branches(query)[1]
+
+    def get_intervals(self, coverage):
+        """Return the IntervalSet of series with data for the last coverage seconds (None meaning forever).
+        They're immutable, so all nodes with the same coverage share one, renewed every second."""
+        now = int(time.time())
+        cached = self.intervals.get(coverage)
+        if cached is None or cached[0] != now:
+            cached = self.intervals[coverage] = (now, IntervalSet([Interval(now - coverage if coverage else 1, now)]))
+        return cached[1]
 
     def find_nodes(self, query):
         logger.debug("find_nodes() query %s", query)
-        # TODO: once we can query influx better for retention periods, honor the start/end time in the FindQuery object
         with self.statsd_client.timer('service_is_graphite-api.action_is_yield_nodes.target_type_is_gauge.unit_is_ms.what_is_query_duration'):
-            for (name, res) in self.get_leaves(query):
-                yield InfluxLeafNode(name, InfluxdbReader(
-                    self.client, name, res, self.statsd_client))
-            for name in self.get_branches(query):
-                logger.debug("Yielding branch %s" % (name,))
-                yield BranchNode(name)
-
-    def fetch_multi(self, nodes, start_time, end_time):
-        series = ', '.join(['"%s"' % node.path for node in nodes])
-        # use the step of the node that is the most coarse
-        # not sure if there's a better way? can we combine series
-        # with different steps (and use the optimal step for each?)
-        # probably not
-        step = max([node.reader.step for node in nodes])
-        query = 'select mean(value) as value from %s where (time > %ds and time <= %ds) GROUP BY time(%ss)' % (
-                series, start_time, end_time, step)
+            # the profile ends before the first node is yielded, as the caller may do
+            # other things (in this thread) before it has consumed all of them
+            profile = self.profiler.begin('find', query.pattern)
+            try:
+                with self.profiler.phase('compile_glob'):
+                    compile_glob(query.pattern)
+                found = None
+                if self.config['index_snapshot_path']:
+                    found = self.find_in_snapshot(query)
+                if found is None and self.config['index_enabled']:
+                    found = self.find_in_index(query)
+                if found is None:
+                    found = self.get_leaves_and_branches(query)
+                leaves, branches = found
+                if profile is not None:
+                    profile.count('leaves', len(leaves))
+                    profile.count('branches', len(branches))
+            finally:
+                self.profiler.end(profile)
+            for node in self._make_nodes(query, leaves, branches):
+                yield node
+
+    def _make_nodes(self, query, leaves, branches):
+        """Yield the nodes for the leaves and branches found for query"""
+        # series whose tiers all expired before the end of the query have no data for it
+        end_time = getattr(query, 'endTime', None)
+        now = int(time.time())
+        get_tiers = self.step_resolver.get_tiers
+        for (name, res) in leaves:
+            tiers = get_tiers(name)
+            if tiers and end_time:
+                coverage = _tiers_coverage(tiers)
+                if coverage and end_time < now - coverage:
+                    continue
+            yield CompactLeafNode(_intern(name), self, res, tiers)
+        for name in branches:
+            logger.debug("Yielding branch %s", name)
+            yield BranchNode(name)
+
+    def fetch_multi(self, nodes, start_time, end_time, max_data_points=None):
+        """Fetch the datapoints of all nodes.
+        When the range would have more than max_data_points (or the configured default)
+        points per series, they are aggregated into fewer, coarser buckets by influxdb."""
+        profile = self.profiler.begin('fetch', nodes[0].path if nodes else None)
+        try:
+            time_info, data = self._fetch_multi(nodes, start_time, end_time, max_data_points)
+            if profile is not None:
+                profile.count('series', len(data))
+                profile.count('points', sum(len(values) for values in data.values()))
+            return time_info, data
+        finally:
+            self.profiler.end(profile)
+
+    def _route(self, nodes, start_time, end_time, max_data_points):
+        """Decide the step to fetch nodes at, and how to query them.
+        Returns (step, paths, groups), groups as described in _fetch_groups."""
+        now = int(time.time())
+        groups = {}
+        # only series with retention tiers are looked up in here, so the others cost nothing extra
+        tiered = {}
+        get_tiers = self.step_resolver.get_tiers
+        for node in nodes:
+            path = node.path
+            tiers = get_tiers(path)
+            if tiers:
+                tiered[path] = tiers
+                # like whisper, series with retention tiers are read at the step of the
+                # finest tier that still has data for the start of the range
+                native_step = _covering_tier(tiers, start_time, now)[1]
+            else:
+                native_step = node.reader.step
+            groups.setdefault(native_step, []).append(path)
+        paths = [path for group in groups.values() for path in group]
+        # graphite wants a single step for all series.
+        # 'max' queries all series at the step of the node that is the most coarse,
+        # 'min' queries every series at its own step, and repeats the values of coarser
+        # series so they line up with the finest one.
+        if self.config['fetch_step_mode'] == 'min':
+            step = reduce(gcd, groups)
+        else:
+            step = max(groups)
+            groups = {step: paths}
+        base_step = None
+        max_data_points = max_data_points or self.config['max_data_points']
+        if max_data_points and (end_time - start_time) // step > max_data_points:
+            # group by a multiple of every native step that keeps us within the budget
+            base_step = reduce(_lcm, groups)
+            step = base_step * -(-(end_time - start_time) // base_step // max_data_points)
+            step = self._align_to_rollups(step, base_step, tiered, start_time, now)
+            groups = {step: paths}
+        routes = {}
+        for (group_step, group_paths) in groups.items():
+            if base_step is not None:
+                route = (group_step, self._rollup_for(group_step, base_step), None, None)
+            else:
+                route = (group_step, None, None, None)
+            if not tiered:
+                routes[route] = group_paths
+                continue
+            tier_routes = {}
+            for path in group_paths:
+                tiers = tiered.get(path)
+                if tiers:
+                    # series of the same schema rule share their tiers
+                    tier_route = tier_routes.get(tiers)
+                    if tier_route is None:
+                        tier_route = tier_routes[tiers] = (group_step,) + _tier_route(tiers, group_step, start_time, now)
+                    routes.setdefault(tier_route, []).append(path)
+                else:
+                    routes.setdefault(route, []).append(path)
+        return step, paths, routes
+
+    def _fetch_multi(self, nodes, start_time, end_time, max_data_points):
+        with self.profiler.phase('route'):
+            step, paths, groups = self._route(nodes, start_time, end_time, max_data_points)
+        time_info = start_time, end_time, step
+        cache_key = _fetch_key(paths, step, start_time, end_time)
+        if self.fetch_cache is not None:
+            data = self.fetch_cache.get(cache_key)
+            if data is not None:
+                self.statsd_client.incr('service_is_graphite-api.target_type_is_count.unit_is_req.action_is_fetch_cache_hit')
+                self.profiler.count('cache_hits')
+                return time_info, dict(data)
+            self.statsd_client.incr('service_is_graphite-api.target_type_is_count.unit_is_req.action_is_fetch_cache_miss')
+        if self.singleflight is None:
+            data = self._fetch_groups(groups, start_time, end_time, step)
+        else:
+            key = _coalesce_key(paths, step, start_time, end_time, groups)
+            data, coalesced = self.singleflight.do(key, self._fetch_groups,
+                                                   groups, start_time, end_time, step)
+            if coalesced:
+                self.statsd_client.incr('service_is_graphite-api.target_type_is_count.unit_is_req.action_is_coalesced_fetch')
+                self.profiler.count('coalesced')
+                data = dict(data)
+        if self.fetch_cache is not None:
+            data = self._cache_fetch(cache_key, step, data)
+        return time_info, data
+
+    def _cache_fetch(self, cache_key, step, data):
+        """Put the data of a fetch in the fetch cache, and return a copy the caller can modify"""
+        # once the last bucket is closed, the result won't change anymore
+        if cache_key[3] + step <= time.time():
+            ttl = self.config['fetch_cache_historical_ttl']
+        else:
+            ttl = self.config['fetch_cache_ttl']
+        self.fetch_cache.put(cache_key, data, _estimate_size(data), ttl)
+        return dict(data)
+
+    def _align_to_rollups(self, step, base_step, tiered, start_time, now):
+        """Round step up to a multiple of the coarsest rollup (or retention tier with data for
+        start_time) that isn't coarser than step itself, so its buckets can be read from those
+        rollups rather than from the raw data, at the cost of at most twice as few points.
+        Steps stay a multiple of base_step."""
+        rollup_steps = set(rollup_step for (rollup_step, _) in self.config['rollups'])
+        for tiers in set(tiered.values()):
+            rollup_steps.update(tier[1] for tier in tiers[1:] if not tier[2] or now - tier[2] <= start_time)
+        candidates = [_lcm(base_step, rollup_step) for rollup_step in rollup_steps if rollup_step > base_step]
+        candidates = [candidate for candidate in candidates if candidate <= step]
+        if not candidates:
+            return step
+        coarsest = max(candidates)
+        return coarsest * -(-step // coarsest)
+
+    def _rollup_for(self, step, native_step):
+        """Return the retention policy holding the coarsest rollups (coarser than the native step)
+        we can aggregate into buckets of step seconds, or None to use the raw data"""
+        rollups = [(rollup_step, retention_policy) for (rollup_step, retention_policy) in self.config['rollups']
+                   if step % rollup_step == 0 and rollup_step > native_step]
+        return max(rollups)[1] if rollups else None
+
+    def _fetch_groups(self, groups, start_time, end_time, step):
+        """Fetch every group of paths at its own step (and from its own retention policies, if any),
+        in chunks of at most fetch_chunk_size series,
+        and merge the results into a single dict with all values at the given step.
+        groups maps (step, retention policy, recent retention policy, split) to paths, see _tier_route.
+        With fetch_concurrency > 1, chunks are fetched in parallel."""
+        chunks = self._chunks(groups)
+        if self.executor is None or len(chunks) == 1:
+            results = [self._fetch_chunk(paths, start_time, end_time, group_step, step, route)
+                       for (paths, group_step, route) in chunks]
+        else:
+            submitted = time.time()
+            fetch_chunk = self.profiler.wrap(self._fetch_chunk)
+            futures = [self.executor.submit(fetch_chunk, paths, start_time, end_time, group_step, step,
+                                            route, submitted)
+                       for (paths, group_step, route) in chunks]
+            results = [future.result() for future in futures]
+        data = {}
+        for chunk in results:
+            data.update(chunk)
+        return data
+
+    def _chunks(self, groups):
+        """Split groups into (paths, step, route) chunks of at most fetch_chunk_size series"""
+        chunk_size = self.config['fetch_chunk_size']
+        return [(paths[i:i + chunk_size], key[0], key[1:])
+                for (key, paths) in groups.items()
+                for i in range(0, len(paths), chunk_size)]
+
+    def _fetch_chunk(self, paths, start_time, end_time, group_step, step, route=None, submitted=None):
+        if submitted is not None:
+            started = time.time()
+            self.statsd_client.timing('service_is_graphite-api.target_type_is_gauge.unit_is_ms.what_is_fetch_queue_wait',
+                                      (started - submitted) * 1000)
+        (retention_policy, recent_policy, split) = route or (None, None, None)
+        if recent_policy is not None and split <= end_time:
+            data = self._fetch_stitched(paths, start_time, end_time, group_step, retention_policy, recent_policy, split)
+        else:
+            data = self._fetch_datapoints(paths, start_time, end_time, group_step, retention_policy)
+        if group_step != step:
+            for (path, values) in data.items():
+                data[path] = _upsample(values, start_time, end_time, group_step, step)
+        if submitted is not None:
+            self.statsd_client.timing('service_is_graphite-api.target_type_is_gauge.unit_is_ms.what_is_fetch_execution',
+                                      (time.time() - started) * 1000)
+        return data
+
+    def _fetch_stitched(self, paths, start_time, end_time, step, retention_policy, recent_policy, split):
+        """Fetch the buckets before split from retention_policy, and the others from recent_policy"""
+        old_data = self._query_datapoints(
+            paths, start_time, split - step, step, retention_policy,
+            where='time > %ds and time < %ds' % (start_time, split), fill=False)
+        recent_data = self._query_datapoints(
+            paths, split, end_time, step, recent_policy,
+            where='time >= %ds and time <= %ds' % (split, end_time), fill=False)
+        return _join_stitched(paths, old_data, recent_data, start_time, end_time, step, split)
+
+    def _fetch_datapoints(self, paths, start_time, end_time, step, retention_policy=None):
+        """Like _query_datapoints, but when incremental fetching is enabled, reuse the
+        closed buckets of earlier fetches and only query influxdb for the rest.
+
+        The result is identical to that of a full query: the first bucket is always
+        queried, because the full query excludes points at exactly start_time from it,
+        and only buckets that were complete and closed when they were fetched are kept."""
+        if self.fetch_history is None:
+            return self._query_datapoints(paths, start_time, end_time, step, retention_policy)
+        head = start_time - start_time % step
+        last = end_time - end_time % step
+        cached_from = head + step
+        histories = [self.fetch_history.get((path, step, retention_policy)) for path in paths]
+        tail_from = None
+        if last >= cached_from and all(h is not None and h[0] <= cached_from for h in histories):
+            # the last bucket is cut off at end_time, so it's always queried as well
+            tail_from = min([last] + [first + len(values) * step for (first, values) in histories])
+            if tail_from <= cached_from:
+                tail_from = None
+        if tail_from is None:
+            data = self._query_datapoints(paths, start_time, end_time, step, retention_policy)
+        else:
+            self.statsd_client.incr('service_is_graphite-api.target_type_is_count.unit_is_req.action_is_incremental_fetch')
+            head_data = self._query_datapoints(
+                paths, start_time, head, step, retention_policy,
+                where='time > %ds and time < %ds' % (start_time, cached_from), fill=False)
+            tail_data = self._query_datapoints(
+                paths, tail_from, end_time, step, retention_policy,
+                where='time >= %ds and time <= %ds' % (tail_from, end_time), fill=False)
+            num_tail = (last - tail_from) // step + 1
+            data = {}
+            for (path, (first, history)) in zip(paths, histories):
+                offset = (cached_from - first) // step
+                values = head_data.get(path, [None]) + \
+                    history[offset:offset + (tail_from - cached_from) // step] + \
+                    tail_data.get(path, [None] * num_tail)
+                # like influxdb, leave out series without any data in the requested range
+                data[path] = values if any(v is not None for v in values) else []
+        self._update_fetch_history(data, start_time, end_time, step, retention_policy)
+        return data
+
+    def _update_fetch_history(self, data, start_time, end_time, step, retention_policy=None):
+        """Remember the buckets of data that were complete (fully within the queried range)
+        and closed (old enough to not receive new points anymore)"""
+        head = start_time - start_time % step
+        cached_from = head + step
+        closed_until = min(end_time, int(time.time()) - self.config['incremental_fetch_lag'])
+        num_buckets = (closed_until - closed_until % step - cached_from) // step
+        if num_buckets <= 0:
+            return
+        for (path, values) in data.items():
+            values = values[1:num_buckets + 1] if values else [None] * num_buckets
+            old = self.fetch_history.get((path, step, retention_policy))
+            if old is not None and old[0] < cached_from <= old[0] + len(old[1]) * step:
+                values = old[1][:(cached_from - old[0]) // step] + values
+                first = old[0]
+            else:
+                first = cached_from
+            self.fetch_history.put((path, step, retention_policy), (first, values), _values_size(values),
+                                   self.config['fetch_cache_historical_ttl'])
+
+    def _query_datapoints(self, paths, start_time, end_time, step, retention_policy=None, where=None, fill=True):
+        """Fetch the mean per step of all series in paths, returns a dict path -> list of values,
+        one per bucket from start_time's until end_time's.
+        If fill is set, series without any data in the range are included with an empty list."""
+        query = _datapoints_query(paths, start_time, end_time, step, retention_policy, where)
         logger.debug('fetch_multi() query: %s', query)
-        logger.debug('fetch_multi() - start_time: %s - end_time: %s, step %s',
-                     datetime.datetime.fromtimestamp(float(start_time)), datetime.datetime.fromtimestamp(float(end_time)), step)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('fetch_multi() - start_time: %s - end_time: %s, step %s',
+                         datetime.datetime.fromtimestamp(float(start_time)), datetime.datetime.fromtimestamp(float(end_time)), step)
 
+        first_bucket = start_time - start_time % step
+        num_buckets = (end_time - end_time % step - first_bucket) // step + 1
         with self.statsd_client.timer('service_is_graphite-api.ext_service_is_influxdb.target_type_is_gauge.unit_is_ms.action_is_select_datapoints'):
             logger.debug("Calling influxdb multi fetch with query - %s", query)
-            data = self.client.query(query, params=_INFLUXDB_CLIENT_PARAMS)
-        logger.debug('fetch_multi() - Retrieved %d result set(s)', len(data))
-        data = _make_graphite_api_points_list(data)
-        # some series we requested might not be in the resultset.
-        # this is because influx doesn't include series that had no values
-        # this is a behavior that some people actually appreciate when graphing, but graphite doesn't do this (yet),
-        # and we want to look the same, so we must add those back in.
-        # a better reason though, is because for advanced alerting cases like bosun, you want all entries even if they have no data, so you can properly
-        # compare, join, or do logic with the targets returned for requests for the same data but from different time ranges, you want them to all
-        # include the same keys.
-        query_keys = set([node.path for node in nodes])
-        for key in query_keys:
-            data.setdefault(key, [])
-        time_info = start_time, end_time, step
-        for key in data:
-            data[key] = [v[1] for v in data[key]]
-        return time_info, data
+            self.profiler.count('queries')
+            if self.config['fetch_streaming']:
+                # let influxdb stream the response in chunks, and only keep the
+                # chunk being read and the values of the series read so far around.
+                # reading the chunks and converting their points interleave, so they're one phase
+                with self.profiler.phase('query_streaming'):
+                    chunks = self.client.query(query, params=_INFLUXDB_CLIENT_PARAMS, chunked=True,
+                                               chunk_size=self.config['fetch_stream_chunk_size'])
+                    data = dict(_iter_chunked_buckets(chunks, first_bucket, num_buckets, step))
+            else:
+                # the influxdb client does the request and decodes the json response
+                with self.profiler.phase('query'):
+                    data = self.client.query(query, params=_INFLUXDB_CLIENT_PARAMS)
+                logger.debug('fetch_multi() - Retrieved %d result set(s)', len(data))
+                with self.profiler.phase('decode'):
+                    data = _read_buckets(data.raw, first_bucket, num_buckets, step)
+        if fill:
+            _fill_missing(data, paths)
+        return data
@@ -0,0 +1,271 @@
+"""Asyncio variant of the InfluxDB finder (python 3.5+, needs aiohttp).
+
+AsyncInfluxdbFinder's find_nodes, fetch_multi and assure_series are coroutines, that query
+InfluxDB with a non-blocking client keeping a pool of connections alive.  SyncInfluxdbFinder
+runs one on an event loop in a background thread, for graphite-api and graphite-web."""
+import json
+import base64
+import asyncio
+import logging
+import threading
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from influxdb.exceptions import InfluxDBClientError
+from influxdb.resultset import ResultSet
+from graphite_influxdb import (InfluxdbFinder, compile_glob, _INFLUXDB_CLIENT_PARAMS, _series_names,
+                               _datapoints_query, _read_buckets, _fill_missing, _join_stitched, _fetch_key,
+                               _coalesce_key, _upsample)
+
+logger = logging.getLogger('graphite_influxdb')
+
+
+class AsyncInfluxDBClient(object):
+    """Non-blocking client for the /query endpoint of InfluxDB, returning ResultSets like InfluxDBClient.query.
+    At most pool_size queries are in flight at once, over connections that are kept alive.
+    The connections belong to the event loop of the first query, close() them when done."""
+    __slots__ = ('url', 'database', 'headers', 'timeout', 'pool_size', 'session')
+
+    def __init__(self, host='localhost', port=8086, username='root', password='root', database=None,
+                 ssl=False, timeout=None, pool_size=10):
+        self.url = '%s://%s:%s/query' % ('https' if ssl else 'http', host, port)
+        self.database = database
+        self.headers = {}
+        if username:
+            credentials = ('%s:%s' % (username, password or '')).encode('utf-8')
+            self.headers['Authorization'] = 'Basic %s' % base64.b64encode(credentials).decode('ascii')
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            # like InfluxDBClient, don't verify certificates
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ssl=False)
+            self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+        return self.session
+
+    async def query(self, query, params=None):
+        params = dict(params or {}, q=query)
+        if self.database:
+            params['db'] = self.database
+        async with self.get_session().get(self.url, params=params) as response:
+            body = await response.text()
+            if response.status != 200:
+                raise InfluxDBClientError(body, response.status)
+        results = [ResultSet(result) for result in json.loads(body).get('results', [])]
+        return results[0] if len(results) == 1 else results
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class AsyncInfluxdbFinder(object):
+    """Finder whose finds and fetches are coroutines, so an event loop can have many in flight.
+    The configuration, schemas, series index, snapshot and caches are those of the InfluxdbFinder
+    it wraps, and the leaf nodes it returns fetch through that one when read on their own.
+
+    Incremental fetches, streaming and profiling are left to InfluxdbFinder.
+    Use a finder from a single event loop."""
+    __fetch_multi__ = 'influxdb'
+    __slots__ = ('finder', 'client', 'config', 'statsd_client', 'flights')
+
+    def __init__(self, config=None):
+        if aiohttp is None:
+            raise ImportError("AsyncInfluxdbFinder needs the 'aiohttp' module (pip install aiohttp)")
+        self.finder = InfluxdbFinder(config)
+        config = self.config = self.finder.config
+        self.statsd_client = self.finder.statsd_client
+        # the pool size caps the number of queries this finder has in flight, like the threads of fetch_concurrency
+        pool_size = config['fetch_concurrency'] if config['fetch_concurrency'] > 1 else 10
+        self.client = AsyncInfluxDBClient(config['host'], config['port'], config['user'], config['passw'],
+                                          config['db'], config['ssl'], config['query_timeout'], pool_size)
+        # key -> future of the identical request in flight, see _coalesce
+        self.flights = {}
+
+    async def close(self):
+        await self.client.close()
+
+    async def _coalesce(self, key, func, *args):
+        """Like SingleFlight.do, for coroutines: await func(*args), unless an identical call is
+        in flight already, then await its result instead.  Returns (result, coalesced)"""
+        future = self.flights.get(key)
+        if future is not None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.config['coalesce_timeout']), True
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                # only give up if it's us being cancelled, not the call we waited for
+                if not future.cancelled():
+                    raise
+            return await func(*args), False
+        future = self.flights[key] = asyncio.get_event_loop().create_future()
+        try:
+            result = await func(*args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the waiters get it, if there are any
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self.flights[key]
+
+    async def assure_series(self, query):
+        if self.finder.singleflight is None:
+            return await self._lookup_series(query)
+        series, coalesced = await self._coalesce(('series', query.pattern), self._lookup_series, query)
+        if coalesced:
+            self.statsd_client.incr('service_is_graphite-api.target_type_is_count.unit_is_req.action_is_coalesced_series_lookup')
+            series = list(series)
+        return series
+
+    async def _lookup_series(self, query):
+        series = None
+        if self.finder.es:
+            # the elasticsearch client blocks, so it runs in the default executor
+            series = await asyncio.get_event_loop().run_in_executor(None, self.finder._es_series, query)
+        # if no ES configured, or ES failed, try influxdb.
+        if series is None:
+            with self.statsd_client.timer('service_is_graphite-api.ext_service_is_influxdb.target_type_is_gauge.unit_is_ms.action_is_get_series'):
+                _query = self.finder._series_query(query)
+                logger.debug("assure_series() Calling influxdb with query - %s", _query)
+                series = _series_names(await self.client.query(_query, params=_INFLUXDB_CLIENT_PARAMS))
+        return series
+
+    async def get_leaves_and_branches(self, query):
+        return self.finder.match_series(query, await self.assure_series(query))
+
+    async def get_leaves(self, query):
+        return (await self.get_leaves_and_branches(query))[0]
+
+    async def get_branches(self, query):
+        return (await self.get_leaves_and_branches(query))[1]
+
+    async def find_nodes(self, query):
+        """Return the list of nodes matching query"""
+        logger.debug("find_nodes() query %s", query)
+        with self.statsd_client.timer('service_is_graphite-api.action_is_yield_nodes.target_type_is_gauge.unit_is_ms.what_is_query_duration'):
+            compile_glob(query.pattern)
+            found = None
+            # (re)building the index or snapshot lists all series with the blocking client
+            loop = asyncio.get_event_loop()
+            if self.config['index_snapshot_path']:
+                found = await loop.run_in_executor(None, self.finder.find_in_snapshot, query)
+            if found is None and self.config['index_enabled']:
+                found = await loop.run_in_executor(None, self.finder.find_in_index, query)
+            if found is None:
+                found = await self.get_leaves_and_branches(query)
+            leaves, branches = found
+        return list(self.finder._make_nodes(query, leaves, branches))
+
+    async def fetch_multi(self, nodes, start_time, end_time, max_data_points=None):
+        """Fetch the datapoints of all nodes, like InfluxdbFinder.fetch_multi.
+        All chunks and retention policies are queried concurrently."""
+        finder = self.finder
+        step, paths, groups = finder._route(nodes, start_time, end_time, max_data_points)
+        time_info = start_time, end_time, step
+        cache_key = _fetch_key(paths, step, start_time, end_time)
+        if finder.fetch_cache is not None:
+            data = finder.fetch_cache.get(cache_key)
+            if data is not None:
+                self.statsd_client.incr('service_is_graphite-api.target_type_is_count.unit_is_req.action_is_fetch_cache_hit')
+                return time_info, dict(data)
+            self.statsd_client.incr('service_is_graphite-api.target_type_is_count.unit_is_req.action_is_fetch_cache_miss')
+        if finder.singleflight is None:
+            data = await self._fetch_groups(groups, start_time, end_time, step)
+        else:
+            key = _coalesce_key(paths, step, start_time, end_time, groups)
+            data, coalesced = await self._coalesce(key, self._fetch_groups,
+                                                   groups, start_time, end_time, step)
+            if coalesced:
+                self.statsd_client.incr('service_is_graphite-api.target_type_is_count.unit_is_req.action_is_coalesced_fetch')
+                data = dict(data)
+        if finder.fetch_cache is not None:
+            data = finder._cache_fetch(cache_key, step, data)
+        return time_info, data
+
+    async def _fetch_groups(self, groups, start_time, end_time, step):
+        results = await asyncio.gather(*[self._fetch_chunk(paths, start_time, end_time, group_step, step, route)
+                                         for (paths, group_step, route) in self.finder._chunks(groups)])
+        data = {}
+        for chunk in results:
+            data.update(chunk)
+        return data
+
+    async def _fetch_chunk(self, paths, start_time, end_time, group_step, step, route):
+        (retention_policy, recent_policy, split) = route
+        if recent_policy is not None and split <= end_time:
+            old_data, recent_data = await asyncio.gather(
+                self._query_datapoints(paths, start_time, split - step, group_step, retention_policy,
+                                       where='time > %ds and time < %ds' % (start_time, split), fill=False),
+                self._query_datapoints(paths, split, end_time, group_step, recent_policy,
+                                       where='time >= %ds and time <= %ds' % (split, end_time), fill=False))
+            data = _join_stitched(paths, old_data, recent_data, start_time, end_time, group_step, split)
+        else:
+            data = await self._query_datapoints(paths, start_time, end_time, group_step, retention_policy)
+        if group_step != step:
+            for (path, values) in data.items():
+                data[path] = _upsample(values, start_time, end_time, group_step, step)
+        return data
+
+    async def _query_datapoints(self, paths, start_time, end_time, step, retention_policy=None, where=None, fill=True):
+        query = _datapoints_query(paths, start_time, end_time, step, retention_policy, where)
+        logger.debug('fetch_multi() query: %s', query)
+        first_bucket = start_time - start_time % step
+        num_buckets = (end_time - end_time % step - first_bucket) // step + 1
+        with self.statsd_client.timer('service_is_graphite-api.ext_service_is_influxdb.target_type_is_gauge.unit_is_ms.action_is_select_datapoints'):
+            data = await self.client.query(query, params=_INFLUXDB_CLIENT_PARAMS)
+            data = _read_buckets(data.raw, first_bucket, num_buckets, step)
+        if fill:
+            _fill_missing(data, paths)
+        return data
+
+
+class SyncInfluxdbFinder(object):
+    """Blocking finder for graphite-api and graphite-web, running an AsyncInfluxdbFinder
+    on an event loop in a background thread.  The finds and fetches of all threads
+    share its connection pool, and identical ones in flight share their queries."""
+    __fetch_multi__ = 'influxdb'
+    __slots__ = ('finder', 'loop', 'thread')
+
+    def __init__(self, config=None):
+        self.finder = AsyncInfluxdbFinder(config)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='graphite_influxdb-event-loop')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def assure_series(self, query):
+        return self._run(self.finder.assure_series(query))
+
+    def get_leaves(self, query):
+        return self._run(self.finder.get_leaves(query))
+
+    def get_branches(self, query):
+        return self._run(self.finder.get_branches(query))
+
+    def find_nodes(self, query):
+        return iter(self._run(self.finder.find_nodes(query)))
+
+    def fetch_multi(self, nodes, start_time, end_time, max_data_points=None):
+        return self._run(self.finder.fetch_multi(nodes, start_time, end_time, max_data_points))
+
+    def close(self):
+        """Close the connections and stop the event loop"""
+        self._run(self.finder.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -9,10 +9,11 @@ setup(
     author_email='dieter@vimeo.com',
     description=('Influxdb backend plugin for graphite-web and graphite-api'),
     long_description=open('README.rst').read(),
-    py_modules=('graphite_influxdb',),
+    py_modules=('graphite_influxdb', 'graphite_influxdb_async'),
     zip_safe=False,
     include_package_data=True,
     platforms='any',
+    python_requires='>=2.7',
     classifiers=(
         'Intended Audience :: Developers',
         'Intended Audience :: System Administrators',
@@ -20,7 +21,12 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 2',
+        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.6',
         'Topic :: System :: Monitoring',
     ),
     install_requires=open('requirements.txt').readlines(),
+    # graphite_influxdb_async needs python 3.5+
+    extras_require={'async': ['aiohttp; python_version >= "3.5"']},
 )
@@ -0,0 +1,165 @@
+"""Tests of the async finder, which needs python 3.5+.  test_graphite_influxdb_async loads them there."""
+import asyncio
+import unittest
+from influxdb.exceptions import InfluxDBClientError
+import graphite_influxdb
+import graphite_influxdb_async
+from test_graphite_influxdb import Query, FakeInfluxDBClient
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+
+class FakeAsyncInfluxDBClient(object):
+    """Answers like FakeInfluxDBClient, after yielding to the event loop"""
+
+    def __init__(self, client, error=None):
+        self.client = client
+        self.error = error
+
+    async def query(self, query, params=None):
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            self.client.queries.append(query)
+            raise self.error
+        return self.client.query(query, params)
+
+    async def close(self):
+        pass
+
+
+@unittest.skipIf(web is None, "aiohttp not installed")
+class AsyncFinderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.series = ['a.b.c', 'a.b.d', 'a.b', 'a.e.f', 'x.y', 'a.b.c.deep']
+        self.config = {'influxdb': {'db': 'unit_test',
+                                    'schema': [('^x', 10)],
+                                    'log_level': 'info',
+                                    },}
+        self.finder = graphite_influxdb_async.AsyncInfluxdbFinder(self.config)
+        self.client = FakeInfluxDBClient(self.series)
+        self.client.points = {'a.b': [(1000, 1), (1060, 3), (1070, 5)],
+                              'x.y': [(1010, 2)]}
+        self.finder.client = FakeAsyncInfluxDBClient(self.client)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_find_nodes(self):
+        sync_finder = graphite_influxdb.InfluxdbFinder(self.config)
+        sync_finder.client = self.client
+        for pattern in ['*', 'a.*', 'a.b.*', 'a.{b,e}.*', '*.y', 'nope.*']:
+            found = sorted((n.path, n.is_leaf) for n in self.run_async(self.finder.find_nodes(Query(pattern))))
+            expected = sorted((n.path, n.is_leaf) for n in sync_finder.find_nodes(Query(pattern)))
+            self.assertEqual(found, expected, msg="Mismatch for %s" % pattern)
+
+    def test_fetch_multi(self):
+        nodes = [node for node in self.run_async(self.finder.find_nodes(Query('*.*'))) if node.is_leaf]
+        time_info, data = self.run_async(self.finder.fetch_multi(nodes, 995, 1125))
+        self.assertEqual(time_info, (995, 1125, 60))
+        self.assertEqual(data, {'a.b': [1, 4, None], 'x.y': [2, None, None]})
+
+    def test_chunks_queried_concurrently(self):
+        self.config['influxdb'].update(fetch_chunk_size=1, fetch_step_mode='min')
+        self.finder = graphite_influxdb_async.AsyncInfluxdbFinder(self.config)
+        self.finder.client = FakeAsyncInfluxDBClient(self.client)
+        sync_finder = graphite_influxdb.InfluxdbFinder(self.config)
+        sync_finder.client = self.client
+        nodes = [node for node in sync_finder.find_nodes(Query('*.*')) if node.is_leaf]
+        expected = sync_finder.fetch_multi(nodes, 995, 1125)
+        self.client.queries = []
+        self.assertEqual(self.run_async(self.finder.fetch_multi(nodes, 995, 1125)), expected)
+        self.assertEqual(len(self.client.queries), 2)
+
+    def test_fetches_share_query(self):
+        nodes = [node for node in self.run_async(self.finder.find_nodes(Query('*.*'))) if node.is_leaf]
+        self.client.queries = []
+
+        async def fetch_all():
+            return await asyncio.gather(*[self.finder.fetch_multi(nodes, 995, 1125) for _ in range(5)])
+        results = self.run_async(fetch_all())
+        self.assertEqual(results, [((995, 1125, 60), {'a.b': [1, 4, None], 'x.y': [2, None, None]})] * 5)
+        self.assertEqual(len(self.client.queries), 1)
+        self.assertEqual(self.finder.flights, {})
+
+    def test_overlapping_windows_dont_share_query(self):
+        nodes = [node for node in self.run_async(self.finder.find_nodes(Query('*.*'))) if node.is_leaf]
+        self.client.queries = []
+
+        async def fetch_both():
+            return await asyncio.gather(self.finder.fetch_multi(nodes, 995, 1125),
+                                        self.finder.fetch_multi(nodes, 1001, 1130))
+        results = self.run_async(fetch_both())
+        self.assertEqual(results, [((995, 1125, 60), {'a.b': [1, 4, None], 'x.y': [2, None, None]}),
+                                   ((1001, 1130, 60), {'a.b': [None, 4, None], 'x.y': [2, None, None]})])
+        self.assertEqual(len(self.client.queries), 2)
+
+    def test_errors_reach_all_waiters(self):
+        error = InfluxDBClientError("influxdb went away")
+        self.finder.client = FakeAsyncInfluxDBClient(self.client, error)
+
+        async def find_all():
+            return await asyncio.gather(*[self.finder.assure_series(Query('a.*')) for _ in range(5)],
+                                        return_exceptions=True)
+        self.assertEqual(self.run_async(find_all()), [error] * 5)
+        self.assertEqual(len(self.client.queries), 1)
+
+    def test_sync_adapter(self):
+        finder = graphite_influxdb_async.SyncInfluxdbFinder(self.config)
+        finder.finder.client = FakeAsyncInfluxDBClient(self.client)
+        try:
+            nodes = [node for node in finder.find_nodes(Query('*.*')) if node.is_leaf]
+            self.assertEqual(sorted(node.path for node in nodes), ['a.b', 'x.y'])
+            self.assertEqual(finder.fetch_multi(nodes, 995, 1125),
+                             ((995, 1125, 60), {'a.b': [1, 4, None], 'x.y': [2, None, None]}))
+        finally:
+            finder.close()
+
+
+@unittest.skipIf(web is None, "aiohttp not installed")
+class AsyncInfluxDBClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.requests = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def handle_query(self, request):
+        self.requests.append(dict(request.query))
+        if request.query['q'] == 'bad':
+            return web.Response(status=400, text='{"error": "error parsing query"}')
+        return web.json_response({'results': [{'statement_id': 0, 'series': [
+            {'name': 'a.b', 'columns': ['time', 'value'], 'values': [[1000, 1.0]]}]}]})
+
+    async def query(self, query):
+        app = web.Application()
+        app.router.add_get('/query', self.handle_query)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        client = graphite_influxdb_async.AsyncInfluxDBClient('127.0.0.1', port, 'graphite', 'secret', 'graphite')
+        try:
+            return await client.query(query, params={'epoch': 's'})
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    def test_query(self):
+        result = self.loop.run_until_complete(self.query('select value from "a.b"'))
+        self.assertEqual(list(result.get_points()), [{'time': 1000, 'value': 1.0}])
+        self.assertEqual(self.requests, [{'q': 'select value from "a.b"', 'db': 'graphite', 'epoch': 's'}])
+
+    def test_error(self):
+        with self.assertRaises(InfluxDBClientError) as raised:
+            self.loop.run_until_complete(self.query('bad'))
+        self.assertEqual(raised.exception.code, 400)
@@ -0,0 +1,693 @@
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from influxdb.resultset import ResultSet
+import graphite_influxdb
+
+
+class Query(object):
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+
+class FakeInfluxDBClient(object):
+    """Answers the handful of InfluxQL statements the finder issues from in-memory data"""
+
+    select = re.compile(r'select mean\(value\) as value from (?P<series>.*) '
+                        r'where \((?P<where>.*)\) GROUP BY time\((?P<step>\d+)s\)$')
+    condition = re.compile(r'time (?P<op>[<>]=?) (?P<ts>\d+)s$')
+
+    def __init__(self, series, points=None):
+        self.series = series
+        # series name -> list of (timestamp, value)
+        self.points = points or {}
+        self.queries = []
+
+    def select_mean(self, match):
+        step = int(match.group('step'))
+        conditions = [self.condition.match(c).groups() for c in match.group('where').split(' and ')]
+        lower = min(int(ts) for (op, ts) in conditions if op.startswith('>'))
+        upper = max(int(ts) for (op, ts) in conditions if op.startswith('<'))
+        ops = {'>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+               '<': lambda a, b: a < b, '<=': lambda a, b: a <= b}
+        series = []
+        source = re.match(r'(?:"([^"]+)"\.)?/(.*)/$', match.group('series'))
+        if source:
+            names = [(source.group(1), name) for name in self.series if re.search(source.group(2), name)]
+        else:
+            names = re.findall(r'(?:"([^"]+)"\.)?"([^"]+)"', match.group('series'))
+        # points of series in a retention policy are keyed by (retention policy, name)
+        for (retention_policy, name) in names:
+            key = (retention_policy, name) if retention_policy else name
+            points = [(t, v) for (t, v) in self.points.get(key, [])
+                      if all(ops[op](t, int(ts)) for (op, ts) in conditions)]
+            if not points:
+                continue
+            values = []
+            for bucket in range(lower - lower % step, upper - upper % step + 1, step):
+                bucket_values = [v for (t, v) in points if bucket <= t < bucket + step]
+                values.append([bucket, sum(bucket_values) / float(len(bucket_values))
+                               if bucket_values else None])
+            series.append({'name': name, 'columns': ['time', 'value'], 'values': values})
+        return ResultSet({'series': series})
+
+    def query(self, query, params=None, chunked=False, chunk_size=0):
+        if chunked:
+            return self.query_chunked(query, chunk_size)
+        self.queries.append(query)
+        if query.startswith('show series'):
+            match = re.match('show series from /(.*)/$', query)
+            series = [name for name in self.series
+                      if match is None or re.search(match.group(1), name)]
+            return ResultSet({'series': [{'columns': ['key'],
+                                          'values': [[name] for name in series]}]})
+        match = self.select.match(query)
+        if match:
+            return self.select_mean(match)
+        raise NotImplementedError(query)
+
+    def query_chunked(self, query, chunk_size):
+        """Split the response into chunks of at most chunk_size rows, like influxdb does"""
+        chunk = []
+        for series in self.query(query).raw.get('series', []):
+            rows = series['values']
+            for i in range(0, len(rows), chunk_size):
+                piece = dict(series, values=rows[i:i + chunk_size])
+                if i + chunk_size < len(rows):
+                    piece['partial'] = True
+                chunk.append(piece)
+                if sum(len(p['values']) for p in chunk) >= chunk_size:
+                    yield ResultSet({'series': chunk})
+                    chunk = []
+        if chunk:
+            yield ResultSet({'series': chunk})
+
+
+class FakeElasticsearch(object):
+    """Serves series names in pages through the search/scroll api"""
+
+    def __init__(self, series, fail=False):
+        self.series = series
+        self.fail = fail
+        self.bodies = []
+        self.scrolls = {}
+
+    def page(self, scroll_id):
+        names, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (names[size:], size)
+        return {'_shards': {'successful': 1}, '_scroll_id': scroll_id,
+                'hits': {'hits': [{'fields': {'_id': [name]}} for name in names[:size]]}}
+
+    def search(self, index, size, body, scroll, request_timeout):
+        if self.fail:
+            raise Exception("timed out")
+        self.bodies.append(body)
+        query = body['query']
+        if 'prefix' in query:
+            names = [n for n in self.series if n.startswith(query['prefix']['_id'])]
+        else:
+            names = [n for n in self.series if re.match(query['regexp']['_id'] + '$', n)]
+        scroll_id = str(len(self.bodies))
+        self.scrolls[scroll_id] = (names, size)
+        return self.page(scroll_id)
+
+    def scroll(self, scroll_id, scroll, request_timeout):
+        return self.page(scroll_id)
+
+    def clear_scroll(self, scroll_id):
+        del self.scrolls[scroll_id]
+
+
+class GraphiteInfluxdbTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.series = ['a.b.c', 'a.b.d', 'a.b', 'a.e.f', 'x.y', 'a.b.c.deep']
+        self.config = {'influxdb': {'db': 'unit_test',
+                                    'schema': [('^x', 10)],
+                                    'log_level': 'info',
+                                    'index_enabled': True,
+                                    },}
+        self.finder = graphite_influxdb.InfluxdbFinder(self.config)
+        self.client = self.finder.client = FakeInfluxDBClient(self.series)
+        graphite_influxdb._series_indexes.clear()
+
+
+class SeriesIndexTestCase(GraphiteInfluxdbTestCase):
+
+    def find(self, pattern):
+        return sorted((node.path, node.is_leaf) for node in self.finder.find_nodes(Query(pattern)))
+
+    def test_compile_glob(self):
+        for (glob, matching, non_matching) in [('a*', ['a', 'abc'], ['ba', 'a.b']),
+                                               ('a.b.*', ['a.b.', 'a.b.c'], ['a.b', 'a.b.c.d']),
+                                               ('a.b', ['a.b'], ['a.bc', 'axb']),
+                                               ('{foo,ba*}', ['foo', 'bar'], ['fo', 'x']),
+                                               ('[ab]x', ['ax', 'bx'], ['cx']),
+                                               ('[!ab]x', ['cx'], ['ax']),
+                                               ('[]]', [']'], ['a', '[]]']),
+                                               ('[!]]', ['a'], [']']),
+                                               ('a[]b', ['a[]b'], ['ab', 'a]b']),
+                                               ('[!]', ['[!]'], ['a', '!']),
+                                               ('a[^]x', ['a[^]x'], ['ax', 'a^x']),
+                                               ('a?c', ['abc'], ['ac', 'a.c']),
+                                               ('a+(b)/*', ['a+(b)/c'], ['aab/c']),
+                                               ('*.{x,y}', ['a.x'], ['a.b.x'])]:
+            match = graphite_influxdb.compile_glob(glob)
+            regex = graphite_influxdb.compile_glob_regex('^{0}$', glob)
+            for name in matching:
+                self.assertTrue(match(name), msg="%s should match %s" % (glob, name))
+                self.assertTrue(regex.match(name), msg="%s should match %s" % (glob, name))
+            for name in non_matching:
+                self.assertFalse(match(name), msg="%s should not match %s" % (glob, name))
+                self.assertFalse(regex.match(name), msg="%s should not match %s" % (glob, name))
+            self.assertEqual(match.filter(matching + non_matching), matching)
+
+    def test_compile_regex(self):
+        rec = self.finder.compile_regex('^{0}$', Query('metric_prefix.*'))
+        self.assertEqual(rec.pattern, "^metric_prefix\\.[^\\.]*$")
+        self.assertTrue(rec is self.finder.compile_regex('^{0}$', Query('metric_prefix.*')))
+
+    def test_step_resolver(self):
+        schema = [('^collectd', 10), ('cpu', 1), ('^collectd.*memory', 5), ('', 30)]
+        for resolver in [graphite_influxdb.StepResolver(schema),
+                         graphite_influxdb.StepResolver(schema + [(r'(a)\1', 2)])]:
+            for (name, step) in [('collectd.host.memory', 10), ('cpu.host', 1), ('host.cpu', 30), ('other', 30)]:
+                self.assertEqual(resolver.get_step(name), step)
+                self.assertEqual(resolver.get_step(name), step)
+        self.assertEqual(graphite_influxdb.StepResolver([('^x', 10)]).get_step('y'), 60)
+        self.assertEqual(graphite_influxdb.StepResolver([('^Foo', 10), ('(?i)bar', 1)]).get_step('foo.x'), 60)
+        self.assertEqual(graphite_influxdb.StepResolver([]).get_step('y'), 60)
+
+    def test_find_literal(self):
+        self.assertEqual(self.find('a.b.c'), [('a.b.c', False), ('a.b.c', True)])
+        self.assertEqual(self.find('a.b.zzz'), [])
+
+    def test_find_wildcard(self):
+        self.assertEqual(self.find('*'), [('a', False), ('x', False)])
+        self.assertEqual(self.find('a.*'), [('a.b', False), ('a.b', True), ('a.e', False)])
+        self.assertEqual(self.find('a.{b,e}.*'), [('a.b.c', False), ('a.b.c', True),
+                                                  ('a.b.d', True), ('a.e.f', True)])
+        self.assertEqual(self.find('*.[xy]'), [('x.y', True)])
+
+    def test_leaf_resolution(self):
+        leaves, _ = self.finder.find_in_index(Query('*.*'))
+        self.assertEqual(sorted(leaves), [('a.b', 60), ('x.y', 10)])
+
+    def test_index_is_shared_and_cached(self):
+        self.find('*')
+        other = graphite_influxdb.InfluxdbFinder(self.config)
+        other.client = self.client
+        list(other.find_nodes(Query('a.*')))
+        self.assertEqual(len(self.client.queries), 1)
+
+    def test_unicode_names(self):
+        self.client.series = [u'a.b', u'a.\xe9', u'a.b.c']
+        self.assertEqual(self.find(u'a.*'), [(u'a.b', False), (u'a.b', True), (u'a.\xe9', True)])
+
+    def test_failed_refresh_backs_off(self):
+        index = graphite_influxdb.SeriesIndex()
+        index.maybe_refresh(lambda: ['a.b'], 600)
+        index.built_at -= 600
+        calls = []
+
+        def failing_list_series():
+            calls.append(time.time())
+            raise Exception("influxdb went away")
+        index.maybe_refresh(failing_list_series, 600)
+        for _ in range(100):
+            if not index.refreshing:
+                break
+            time.sleep(0.01)
+        index.maybe_refresh(failing_list_series, 600)
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(index.refreshing)
+        self.assertEqual(index.find('a.*'), (['a.b'], []))
+
+    def test_failed_build_falls_back(self):
+        query = self.client.query
+
+        def failing_query(q, *args, **kwargs):
+            if q == 'show series':
+                raise Exception("influxdb went away")
+            return query(q, *args, **kwargs)
+        self.client.query = failing_query
+        self.assertEqual(self.finder.find_in_index(Query('a.*')), None)
+        self.assertEqual(self.find('a.*'), [('a.b', False), ('a.b', True), ('a.e', False)])
+        # not retried until a minute later
+        self.assertEqual(self.client.queries, ['show series from /^a\\.[^\\.]*/'])
+        self.client.query = query
+        self.assertEqual(self.finder.find_in_index(Query('a.*')), None)
+        self.finder.get_series_index().attempted_at -= 60
+        self.assertEqual(self.find('a.*'), [('a.b', False), ('a.b', True), ('a.e', False)])
+        self.assertEqual(self.client.queries[-1], 'show series')
+
+
+class FetchMultiTestCase(GraphiteInfluxdbTestCase):
+
+    def setUp(self):
+        super(FetchMultiTestCase, self).setUp()
+        self.client.points = {'a.b': [(1000, 1), (1060, 3), (1070, 5)],
+                              'x.y': [(1010, 2)]}
+        self.nodes = [node for node in self.finder.find_nodes(Query('*.*')) if node.is_leaf]
+
+    def test_fetch_multi(self):
+        time_info, data = self.finder.fetch_multi(self.nodes, 995, 1125)
+        self.assertEqual(time_info, (995, 1125, 60))
+        self.assertEqual(data, {'a.b': [1, 4, None], 'x.y': [2, None, None]})
+
+    def test_compact_nodes(self):
+        (node, other) = self.nodes
+        self.assertTrue(node.reader is node)
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertEqual((node.name, node.reader.step, other.reader.step), ('b', 60, 10))
+        self.assertTrue(node.intervals is other.intervals)
+        self.assertEqual(node.fetch(995, 1125), ((995, 1125, 60), [1, 4, None]))
+
+    def test_read_buckets(self):
+        raw = {'series': [{'name': 'full', 'columns': ['time', 'value'],
+                           'values': [[60, 1], [120, None], [180, 3]]},
+                          {'name': 'gaps', 'columns': ['value', 'time'],
+                           'values': [[1, 60], [3, 180], [4, 240]]}]}
+        self.assertEqual(graphite_influxdb._read_buckets(raw, 60, 3, 60),
+                         {'full': [1, None, 3], 'gaps': [1, None, 3]})
+
+    def test_streaming(self):
+        expected = self.finder.fetch_multi(self.nodes, 995, 1300)
+        self.finder.config.update(fetch_streaming=True, fetch_stream_chunk_size=2)
+        self.assertEqual(self.finder.fetch_multi(self.nodes, 995, 1300), expected)
+
+    def test_chunked_queries(self):
+        self.finder.config['fetch_chunk_size'] = 1
+        self.assertEqual(self.finder.fetch_multi(self.nodes, 995, 1125)[1],
+                         {'a.b': [1, 4, None], 'x.y': [2, None, None]})
+        self.assertEqual(len([q for q in self.client.queries if q.startswith('select')]), 2)
+
+    def test_concurrent_chunks(self):
+        self.config['influxdb'].update(fetch_concurrency=4, fetch_chunk_size=1)
+        finder = graphite_influxdb.InfluxdbFinder(self.config)
+        finder.client = self.client
+        self.assertEqual(finder.fetch_multi(self.nodes, 995, 1125)[1],
+                         {'a.b': [1, 4, None], 'x.y': [2, None, None]})
+        self.assertEqual(len([q for q in self.client.queries if q.startswith('select')]), 2)
+
+    def test_max_data_points(self):
+        time_info, data = self.finder.fetch_multi(self.nodes, 995, 1300, max_data_points=2)
+        # 180s buckets, aligned on multiples of 180s
+        self.assertEqual(time_info, (995, 1300, 180))
+        self.assertEqual(data, {'a.b': [3, None, None], 'x.y': [2, None, None]})
+        self.finder.config['fetch_step_mode'] = 'min'
+        self.assertEqual(self.finder.fetch_multi(self.nodes, 995, 1300, max_data_points=2)[1], data)
+        self.assertEqual(self.finder.fetch_multi(self.nodes, 995, 1300, max_data_points=100)[0][2], 10)
+
+    def test_rollups(self):
+        self.finder.config.update(max_data_points=1000, rollups=[[60, 'rp_1m'], [300, 'rp_5m'], [3600, 'rp_1h']])
+        nodes = [node for node in self.nodes if node.path == 'x.y']
+        # the smallest step within the budget is rounded up to a multiple of the coarsest rollup below it
+        for (days, step, retention_policy) in [(1, 120, 'rp_1m'), (7, 900, 'rp_5m'),
+                                               (30, 2700, 'rp_5m'), (365, 32400, 'rp_1h')]:
+            end_time = 1000000000
+            step_found, _, routes = self.finder._route(nodes, end_time - days * 86400, end_time, None)
+            self.assertEqual((step_found, list(routes)), (step, [(step, retention_policy, None, None)]))
+        self.finder.config['max_data_points'] = 2
+        self.assertEqual(self.finder.fetch_multi(nodes, 995, 1300)[0][2], 180)
+        self.assertTrue('from "rp_1m"."x.y" where' in self.client.queries[-1], msg=self.client.queries)
+        # rollups no coarser than the native step are no use
+        self.assertEqual(self.finder.fetch_multi(self.nodes, 995, 1300)[0][2], 180)
+        self.assertTrue(re.search(r'from "(a\.b|x\.y)", "(a\.b|x\.y)" where', self.client.queries[-1]),
+                        msg=self.client.queries)
+
+    def test_step_mode_min(self):
+        self.finder.config['fetch_step_mode'] = 'min'
+        time_info, data = self.finder.fetch_multi(self.nodes, 995, 1125)
+        self.assertEqual(time_info, (995, 1125, 10))
+        self.assertEqual(data, {'a.b': [1] * 3 + [4] * 6 + [None] * 5,
+                                'x.y': [None, None, 2] + [None] * 11})
+
+    def test_aligned_windows_share_entries(self):
+        self.finder.fetch_cache = graphite_influxdb.FetchCache(1 << 20)
+        _, first = self.finder.fetch_multi(self.nodes, 1001, 1125)
+        time_info, second = self.finder.fetch_multi(self.nodes, 1010, 1130)
+        self.assertEqual(time_info, (1010, 1130, 60))
+        self.assertEqual(first, second)
+        self.finder.fetch_multi(self.nodes, 1060, 1140)
+        self.assertEqual(len([q for q in self.client.queries if q.startswith('select')]), 2)
+
+    def test_lru_eviction(self):
+        cache = graphite_influxdb.FetchCache(100)
+        cache.put('a', 1, 60, 10)
+        cache.put('b', 2, 30, 10)
+        cache.get('a')
+        cache.put('c', 3, 30, 10)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        cache.put('d', 4, 10, -1)
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(cache.bytes, 90)
+
+    def test_estimate_size(self):
+        data = {'a.b': [float(i) for i in range(1000)] + [None] * 500, 'x.y': [None] * 100}
+        actual = sum(sys.getsizeof(path) + sys.getsizeof(values) +
+                     sum(sys.getsizeof(value) for value in values if value is not None)
+                     for (path, values) in data.items())
+        estimate = graphite_influxdb._estimate_size(data)
+        self.assertTrue(0.8 * actual < estimate < 1.2 * actual, msg=(estimate, actual))
+
+
+class IncrementalFetchTestCase(GraphiteInfluxdbTestCase):
+
+    def setUp(self):
+        super(IncrementalFetchTestCase, self).setUp()
+        self.series.append('a.empty')
+        self.client.points = {'a.b': [], 'x.y': []}
+        self.add_points(0, 3000)
+        self.nodes = [node for node in self.finder.find_nodes(Query('*.*')) if node.is_leaf]
+        self.nodes += list(self.finder.find_nodes(Query('a.empty')))
+        self.full_finder = graphite_influxdb.InfluxdbFinder(self.config)
+        self.full_finder.client = self.client
+        self.finder.fetch_history = graphite_influxdb.FetchCache(1 << 20)
+
+    def add_points(self, start, end):
+        for ts in range(start, end, 7):
+            self.client.points['a.b'].append((ts, ts % 13))
+            if ts % 3:
+                self.client.points['x.y'].append((ts, ts % 5))
+
+    def assert_same_as_full_query(self, start_time, end_time):
+        expected = self.full_finder.fetch_multi(self.nodes, start_time, end_time)
+        queries = len(self.client.queries)
+        got = self.finder.fetch_multi(self.nodes, start_time, end_time)
+        self.assertEqual(got, expected)
+        return self.client.queries[queries:]
+
+    def test_stitched_equals_full_query(self):
+        self.assertEqual(len(self.assert_same_as_full_query(1000, 2000)), 1)
+        # a refresh over a sliding window only queries the first bucket and the tail
+        queries = self.assert_same_as_full_query(1017, 2090)
+        self.assertEqual(len(queries), 2)
+        self.assertTrue('time >= 1980s' in queries[1], msg=queries)
+        self.add_points(3000, 4000)
+        for (start_time, end_time) in [(1060, 3500), (1200, 3990), (1201, 2000), (1500, 1600)]:
+            self.assert_same_as_full_query(start_time, end_time)
+
+    def test_window_in_one_bucket(self):
+        self.assert_same_as_full_query(1000, 2000)
+        self.assertEqual(len(self.assert_same_as_full_query(1201, 1230)), 1)
+
+
+class RetentionTiersTestCase(GraphiteInfluxdbTestCase):
+
+    def setUp(self):
+        super(RetentionTiersTestCase, self).setUp()
+        self.config['influxdb']['schema'] = [('^a', [['rollup', 60, '1d'], ['raw', 10, 3600]]), ('^x', 10)]
+        self.finder = graphite_influxdb.InfluxdbFinder(self.config)
+        self.client = self.finder.client = FakeInfluxDBClient(self.series)
+        self.now = 1000000
+        self.addCleanup(setattr, time, 'time', time.time)
+        time.time = lambda: self.now
+        self.nodes = [node for node in self.finder.find_nodes(Query('a.b')) if node.is_leaf]
+
+    def selects(self):
+        return [q for q in self.client.queries if q.startswith('select')]
+
+    def test_step_resolver(self):
+        resolver = self.finder.step_resolver
+        self.assertEqual(resolver.get_tiers('a.b'), (('raw', 10, 3600), ('rollup', 60, 86400)))
+        self.assertEqual((resolver.get_step('a.b'), resolver.get_step('x.y')), (10, 10))
+        self.assertEqual(resolver.get_tiers('x.y'), None)
+
+    def test_recent_range_reads_raw_data(self):
+        time_info, _ = self.finder.fetch_multi(self.nodes, self.now - 600, self.now)
+        self.assertEqual(time_info[2], 10)
+        self.assertTrue('from "raw"."a.b" where' in self.selects()[-1], msg=self.selects())
+
+    def test_coarse_buckets_read_rollups(self):
+        # the rollups are cheaper, but only the raw data has the most recent buckets
+        time_info, _ = self.finder.fetch_multi(self.nodes, self.now - 600, self.now, max_data_points=5)
+        self.assertEqual(time_info[2], 120)
+        self.assertTrue('from "rollup"."a.b" where (time > 999400s and time < 999840s)' in self.selects()[-2])
+        self.assertTrue('from "raw"."a.b" where (time >= 999840s and time <= 1000000s)' in self.selects()[-1])
+
+    def test_budget_step_aligns_to_tiers(self):
+        # 90s buckets would fit the budget, but only 120s buckets can be read from the rollups
+        time_info, _ = self.finder.fetch_multi(self.nodes, self.now - 86400, self.now, max_data_points=1000)
+        self.assertEqual(time_info[2], 120)
+        self.assertTrue('from "rollup"."a.b" where' in self.selects()[-2], msg=self.selects())
+
+    def test_stitches_tiers(self):
+        self.client.points = {('rollup', 'a.b'): [(993000, 1), (999780, 2), (999850, 100)],
+                              ('raw', 'a.b'): [(999790, 100), (999850, 3), (999870, 5), (999990, 7)]}
+        time_info, data = self.finder.fetch_multi(self.nodes, self.now - 7200, self.now)
+        self.assertEqual(time_info[2], 60)
+        expected = [None] * 121
+        expected[4], expected[117], expected[118], expected[120] = 1, 2, 4, 7
+        self.assertEqual(data, {'a.b': expected})
+        self.assertEqual(len(self.selects()), 2)
+
+    def test_single_fetch_stitches_tiers(self):
+        self.client.points = {('rollup', 'a.b'): [(993000, 1), (999780, 2), (999850, 100)],
+                              ('raw', 'a.b'): [(999790, 100), (999850, 3), (999870, 5), (999990, 7)]}
+        (node,) = self.nodes
+        time_info, data = self.finder.fetch_multi(self.nodes, self.now - 7200, self.now)
+        self.assertEqual(node.fetch(self.now - 7200, self.now), (time_info, data['a.b']))
+        self.assertEqual(node.fetch(self.now - 600, self.now)[0][2], 10)
+
+    def test_intervals_and_find(self):
+        (node,) = self.nodes
+        self.assertEqual(node.reader.get_intervals().intervals[0].start, self.now - 86400)
+        query = Query('*.*')
+        query.endTime = self.now - 2 * 86400
+        self.assertEqual([node.path for node in self.finder.find_nodes(query) if node.is_leaf], ['x.y'])
+        self.assertEqual(list(self.finder.find_nodes(Query('x.y')))[0].reader.get_intervals().intervals[0].start, 1)
+
+
+class SingleFlightTestCase(GraphiteInfluxdbTestCase):
+
+    def run_concurrently(self, func, num_threads=5, error=None):
+        """Call func from several threads while influxdb is blocked, return what every call
+        returned (or raised), and the queries influxdb got"""
+        release = threading.Event()
+        query = self.client.query
+
+        def blocking_query(*args, **kwargs):
+            release.wait()
+            if error is not None:
+                self.client.queries.append(args[0])
+                raise error
+            return query(*args, **kwargs)
+        self.client.query = blocking_query
+        results = [None] * num_threads
+
+        def run(i):
+            try:
+                results[i] = func()
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        # give every thread time to join the first one's query
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        return results, self.client.queries
+
+    def test_finds_share_query(self):
+        results, queries = self.run_concurrently(lambda: sorted(self.finder.assure_series(Query('a.*'))))
+        self.assertEqual(results, [['a.b', 'a.b.c', 'a.b.c.deep', 'a.b.d', 'a.e.f']] * 5)
+        self.assertEqual(len(queries), 1)
+
+    def test_errors_reach_all_waiters(self):
+        error = Exception("influxdb went away")
+        results, queries = self.run_concurrently(lambda: self.finder.assure_series(Query('a.*')), error=error)
+        self.assertEqual(results, [error] * 5)
+        self.assertEqual(len(queries), 1)
+
+    def test_fetches_share_query(self):
+        self.client.points = {'a.b': [(1000, 1), (1060, 3)]}
+        nodes = [node for node in self.finder.find_nodes(Query('*.*')) if node.is_leaf]
+        self.client.queries = []
+        results, queries = self.run_concurrently(lambda: self.finder.fetch_multi(nodes, 995, 1125))
+        self.assertEqual(results, [((995, 1125, 60), {'a.b': [1, 3, None], 'x.y': []})] * 5)
+        self.assertEqual(len(queries), 1)
+
+    def test_overlapping_windows_dont_share_query(self):
+        self.client.points = {'a.b': [(1000, 1), (1060, 3), (1128, 50)]}
+        nodes = [node for node in self.finder.find_nodes(Query('*.*')) if node.is_leaf]
+        windows = [(995, 1125), (1001, 1130)]
+        expected = dict((window, self.finder.fetch_multi(nodes, *window)) for window in windows)
+        self.client.queries = []
+
+        def fetch():
+            window = windows.pop()
+            return window, self.finder.fetch_multi(nodes, *window)
+        results, queries = self.run_concurrently(fetch, num_threads=2)
+        self.assertEqual(dict(results), expected)
+        self.assertEqual(expected[(1001, 1130)][1]['a.b'], [None, 3, 50])
+        self.assertEqual(len(queries), 2)
+
+    def test_bounded_wait(self):
+        singleflight = graphite_influxdb.SingleFlight(timeout=0.01)
+        release = threading.Event()
+        leader = threading.Thread(target=singleflight.do, args=('key', release.wait))
+        leader.start()
+        time.sleep(0.05)
+        self.assertEqual(singleflight.do('key', lambda: 'own'), ('own', False))
+        release.set()
+        leader.join()
+        self.assertEqual(singleflight.flights, {})
+
+
+class ProfilerTestCase(GraphiteInfluxdbTestCase):
+
+    def setUp(self):
+        super(ProfilerTestCase, self).setUp()
+        graphite_influxdb._profiler = None
+        self.addCleanup(setattr, graphite_influxdb, '_profiler', None)
+        self.config['influxdb'].update(profile_sample_rate=1, index_enabled=False)
+        self.finder = graphite_influxdb.InfluxdbFinder(self.config)
+        self.client = self.finder.client = FakeInfluxDBClient(self.series, {'a.b': [(1000, 1), (1060, 3)]})
+
+    def test_off_by_default(self):
+        finder = graphite_influxdb.InfluxdbFinder({'influxdb': {'db': 'unit_test'}})
+        self.assertTrue(isinstance(finder.profiler, graphite_influxdb.NullProfiler))
+        self.assertFalse(isinstance(finder.profiler, graphite_influxdb.Profiler))
+
+    def test_find_and_fetch_breakdowns(self):
+        nodes = [node for node in self.finder.find_nodes(Query('*.*')) if node.is_leaf]
+        self.finder.fetch_multi(nodes, 995, 1125)
+        find, fetch = graphite_influxdb.recent_profiles()
+        self.assertEqual((find['kind'], find['target']), ('find', '*.*'))
+        self.assertEqual(sorted(find['phases']), ['compile_glob', 'list_series', 'match'])
+        self.assertEqual(find['counts'], {'series': 6, 'leaves': 2, 'branches': 2})
+        self.assertEqual(sorted(fetch['phases']), ['decode', 'query', 'route'])
+        self.assertEqual(fetch['counts'], {'queries': 1, 'series': 2, 'points': 3})
+        self.assertTrue(fetch['duration'] >= sum(fetch['phases'].values()))
+
+    def test_concurrent_chunks_record_into_request(self):
+        self.config['influxdb'].update(fetch_concurrency=4, fetch_chunk_size=1)
+        finder = graphite_influxdb.InfluxdbFinder(self.config)
+        finder.client = self.client
+        nodes = [node for node in finder.find_nodes(Query('*.*')) if node.is_leaf]
+        finder.fetch_multi(nodes, 995, 1125)
+        self.assertEqual(graphite_influxdb.recent_profiles()[-1]['counts']['queries'], 2)
+
+    def test_ring_buffer(self):
+        self.finder.profiler.samples = graphite_influxdb.deque(maxlen=2)
+        for pattern in ['a', 'a.*', 'x.*']:
+            list(self.finder.find_nodes(Query(pattern)))
+        self.assertEqual([p['target'] for p in graphite_influxdb.recent_profiles()], ['a.*', 'x.*'])
+
+
+class SeriesSnapshotTestCase(GraphiteInfluxdbTestCase):
+
+    def setUp(self):
+        super(SeriesSnapshotTestCase, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'series.snapshot')
+        graphite_influxdb._snapshot_indexes.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write_and_read(self):
+        graphite_influxdb.SeriesSnapshot.write(self.path, [('b.x', 10), (u'a.\xe9', 60), ('a.b', 1)])
+        snapshot = graphite_influxdb.SeriesSnapshot(self.path)
+        self.assertEqual(snapshot.size, 3)
+        self.assertEqual(list(snapshot.iter_prefix('a.')), [('a.b', 1), (u'a.\xe9', 60)])
+        self.assertEqual(list(snapshot.iter_prefix('')), [('a.b', 1), (u'a.\xe9', 60), ('b.x', 10)])
+        self.assertEqual(list(snapshot.iter_prefix('c')), [])
+
+    def test_find_matches_direct_find(self):
+        graphite_influxdb.SeriesSnapshot.write(self.path, self.finder._list_all_series_with_steps())
+        for pattern in ['*', 'a.*', 'a.b.*', 'a.{b,e}.*', '*.y', 'a.b.c', 'nope.*']:
+            self.assertEqual(graphite_influxdb.SeriesSnapshot(self.path).find(pattern),
+                             self.finder.get_leaves_and_branches(Query(pattern)),
+                             msg="Mismatch for %s" % pattern)
+
+    def test_built_in_background(self):
+        self.finder.config['index_snapshot_path'] = self.path
+        self.assertEqual(self.finder.find_in_snapshot(Query('*')), None)
+        for thread in graphite_influxdb.threading.enumerate():
+            if thread.name == 'graphite_influxdb-snapshot-refresh':
+                thread.join()
+        queries = len(self.client.queries)
+        self.assertEqual(sorted(node.path for node in self.finder.find_nodes(Query('*.*'))),
+                         ['a.b', 'a.b', 'a.e', 'x.y'])
+        self.assertEqual(len(self.client.queries), queries)
+
+
+class ElasticsearchTestCase(GraphiteInfluxdbTestCase):
+
+    def setUp(self):
+        super(ElasticsearchTestCase, self).setUp()
+        self.finder.config.update(index_enabled=False, es_page_size=2)
+        self.finder.es = FakeElasticsearch(self.series)
+
+    def test_pages_through_all_results(self):
+        self.assertEqual(self.finder.assure_series(Query('a.b.*')), ['a.b.c', 'a.b.d', 'a.b.c.deep'])
+        self.assertEqual(self.finder.es.bodies[0]['query'], {'prefix': {'_id': 'a.b.'}})
+        self.assertEqual(self.finder.es.scrolls, {})
+        self.assertEqual(self.client.queries, [])
+        self.assertEqual(self.finder.get_leaves_and_branches(Query('a.{b,e}.*')),
+                         ([('a.b.c', 60), ('a.b.d', 60), ('a.e.f', 60)], ['a.b.c']))
+
+    def test_truncation(self):
+        counts = []
+
+        class Statsd(graphite_influxdb.NullStatsd):
+            def incr(self, key, count=1):
+                counts.append(key)
+        self.finder.statsd_client = Statsd()
+        self.finder.config.update(es_max_hits=3, es_page_size=2)
+        self.assertEqual(len(self.finder.assure_series(Query('*'))), 3)
+        self.assertEqual(len(counts), 1)
+        # exactly max_hits matches is not a truncation
+        self.assertEqual(self.finder.assure_series(Query('a.b.*')), ['a.b.c', 'a.b.d', 'a.b.c.deep'])
+        self.assertEqual(len(counts), 1)
+
+    def test_depth_fields(self):
+        self.finder.config['es_depth_field'] = 'n{0}'
+        self.assertEqual(self.finder._es_query('a.b*.*.{c,d}'),
+                         {'bool': {'must': [{'term': {'n0': 'a'}},
+                                            {'prefix': {'n1': 'b'}},
+                                            {'exists': {'field': 'n2'}},
+                                            {'regexp': {'n3': '(c|d)'}}]}})
+
+    def test_fallback_to_influxdb(self):
+        self.finder.es.fail = True
+        self.assertEqual(self.finder.assure_series(Query('x.*')), ['x.y'])
+        self.assertEqual(len(self.client.queries), 1)
+
+
+class FindNodesTestCase(GraphiteInfluxdbTestCase):
+
+    def setUp(self):
+        super(FindNodesTestCase, self).setUp()
+        self.finder.config['index_enabled'] = False
+
+    def test_leaves_and_branches_single_listing(self):
+        leaves, branches = self.finder.get_leaves_and_branches(Query('a.*'))
+        self.assertEqual(leaves, [('a.b', 60)])
+        self.assertEqual(branches, ['a.b', 'a.e'])
+        self.assertEqual(len(self.client.queries), 1)
+
+    def test_unicode_names(self):
+        # the influxdb client returns unicode names, which python 2 can't intern
+        self.client.series = [u'a.b', u'a.\xe9', u'a.b.c']
+        nodes = sorted(self.finder.find_nodes(Query(u'a.*')), key=lambda node: node.path)
+        self.assertEqual([(node.path, node.name, node.is_leaf) for node in nodes],
+                         [(u'a.b', u'b', True), (u'a.b', u'b', False), (u'a.\xe9', u'\xe9', True)])
+
+    def test_matches_index(self):
+        for pattern in ['*', 'a.*', 'a.b.*', 'a.{b,e}.*', '*.y', 'a.b.c', 'nope.*']:
+            self.finder.config['index_enabled'] = False
+            found = sorted((n.path, n.is_leaf) for n in self.finder.find_nodes(Query(pattern)))
+            self.finder.config['index_enabled'] = True
+            indexed = sorted((n.path, n.is_leaf) for n in self.finder.find_nodes(Query(pattern)))
+            self.assertEqual(found, indexed, msg="Mismatch for %s" % pattern)
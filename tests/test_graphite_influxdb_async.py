@@ -0,0 +1,5 @@
+import sys
+
+# the async finder and its tests use python 3.5+ syntax, so test runners on python 2 mustn't import them
+if sys.version_info >= (3, 5):
+    from asyncio_cases import AsyncFinderTestCase, AsyncInfluxDBClientTestCase  # noqa